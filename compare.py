@@ -1,7 +1,8 @@
 import os
 import re
+import sys
 import json
-import itertools
+import glob
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -10,6 +11,8 @@ parser.add_argument("--loop", required=False, help="The reference JSON using the
 parser.add_argument("--pip", required=False, help="The reference JSON using the loop.pip instruction.", type=argparse.FileType("r"))
 parser.add_argument("--refLoop", required=False, help="The reference loop JSON.", type=argparse.FileType("r"))
 parser.add_argument("--refPip", required=False, help="The reference pip JSON.", type=argparse.FileType("r"))
+parser.add_argument("--suite", required=False, help="Compare simple.json/pip.json of every test directory in the given folder against all of its references.")
+parser.add_argument("--rename", action="store_true", help="Accept schedules that are equal modulo a consistent renaming of the registers.")
 
 RED = '\x1b[31m'
 GREEN = '\x1b[36m'
@@ -23,61 +26,275 @@ Branch = 4
 
 slotToStr = ["ALU0", "ALU1", "Mult", "Mem", "Branch"]
 
-def swapALUs(bundle):
-    alu0 = bundle[ALU0]
-    bundle[ALU0] = bundle[ALU1]
-    bundle[ALU1] = alu0
+WHITESPACE = re.compile(r"\s+")
+# a general purpose register, but not the x of a hex immediate
+REGISTER = re.compile(r"(?<![0-9A-Za-z])x(\d+)")
 
-    return bundle
+# registers x0-x31 are static, x32-x95 are rotating
+ROTATING_BASE = 32
+ROTATING_COUNT = 64
+# bound on the backtracking of `diffRenamed` over the ALU assignments, per bundle
+SEARCH_STEPS = 64
 
 def rawInst(inst):
-    p = re.compile(r"\s+")
-    return re.sub(p, "", inst).lower()
+    return WHITESPACE.sub("", inst).lower()
 
-def compareInstructions(resI, refI):
-    rawResI = rawInst(resI)
-    rawRefI = rawInst(refI)
+def canonicalBundle(bundle):
+    # Normalize every instruction once. The two ALU slots are interchangeable,
+    # so they are stored in sorted order, which makes equal bundles equal
+    # tuples (and hashes) regardless of the ALU assignment.
+    insts = tuple(rawInst(i) for i in bundle)
+    if len(insts) != 5:
+        return insts
+    return (min(insts[ALU0], insts[ALU1]), max(insts[ALU0], insts[ALU1])) + insts[MULT:]
 
-    return rawResI == rawRefI
+def canonicalize(schedule):
+    return [canonicalBundle(bundle) for bundle in schedule]
 
-def compareBundles(resB, refB, bLoc):
-    for iLoc, (resI, refI) in enumerate(itertools.zip_longest(resB, refB)):
-        if((resI == None) or (refI == None)):
-            return RED + "Bundle length does not match." + RESET
+def splitRegisters(inst):
+    # split an instruction into its text with the registers blanked out and
+    # the list of its register indices
+    regs = tuple(int(idx) for idx in REGISTER.findall(inst))
+    return rawInst(REGISTER.sub("x#", inst)), regs
 
-        if(not compareInstructions(resI, refI)):
-            return RED + "Instruction do not match at bundle " + str(bLoc) + \
-                ", instruction slot: " + slotToStr[iLoc] + ": " + \
-                resI + " != " + refI + RESET
+def joinRegisters(inst):
+    text, regs = inst
+    for reg in regs:
+        text = text.replace("x#", "x" + str(reg), 1)
+    return text
 
-    return ""
+def canonicalizeRenamed(schedule):
+    return [tuple(splitRegisters(inst) for inst in bundle) for bundle in schedule]
 
-def compare(resF, refF):
-    registerEqu = {}
+class RegisterRenaming:
+    # Mapping between the registers of the result and the ones of the
+    # reference, built incrementally. Static registers are mapped by any
+    # bijection. Rotating registers name a value relative to the stage and
+    # iteration (RRB), so they may only be translated, all by the same offset
+    # modulo the rotating file; predicates are not renamed, which keeps the
+    # registers in step with the stages. The journal records the static
+    # registers bound, None for the offset.
+    def __init__(self):
+        self.forward = {}
+        self.backward = {}
+        self.offset = None
+        self.journal = []
 
-    for bLoc, (resB, refB) in enumerate(itertools.zip_longest(resF, refF)):
-        if((resB == None) or (refB == None)):
-            return "[" + RED + "Error" + RESET + "] Schedule length does not match."
+    def bind(self, resReg, refReg):
+        if (resReg < ROTATING_BASE) != (refReg < ROTATING_BASE):
+            return False
+        if resReg >= ROTATING_BASE:
+            offset = (refReg - resReg) % ROTATING_COUNT
+            if self.offset is None:
+                self.offset = offset
+                self.journal.append(None)
+            return self.offset == offset
+        if resReg in self.forward or refReg in self.backward:
+            return self.forward.get(resReg) == refReg and self.backward.get(refReg) == resReg
+        self.forward[resReg] = refReg
+        self.backward[refReg] = resReg
+        self.journal.append(resReg)
+        return True
 
-        bOks = compareBundles(resB, refB, bLoc)
-        bSwapOk = compareBundles(swapALUs(resB), refB, bLoc)
+    def match(self, resI, refI):
+        # bind the registers of two instructions, undoing partial bindings on failure
+        (resText, resRegs), (refText, refRegs) = resI, refI
+        mark = len(self.journal)
+        if resText == refText and len(resRegs) == len(refRegs) and \
+           all(self.bind(a, b) for a, b in zip(resRegs, refRegs)):
+            return True
+        self.rollback(mark)
+        return False
 
-        if((bOks != "") and (bSwapOk != "")):
-            return bOks
+    def rollback(self, mark):
+        while len(self.journal) > mark:
+            resReg = self.journal.pop()
+            if resReg is None:
+                self.offset = None
+            else:
+                del self.backward[self.forward.pop(resReg)]
 
-    return GREEN + "PASSED!" + RESET
+def describeRenamedBundle(resB, refB, bLoc):
+    if len(resB) != len(refB):
+        return "Bundle length does not match at bundle " + str(bLoc) + "."
+
+    # only the text is compared here: the registers depend on the other bundles
+    mismatches = []
+    slots = range(len(resB))
+    if len(resB) == 5:
+        if sorted(i[0] for i in resB[ALU0:MULT]) != sorted(i[0] for i in refB[ALU0:MULT]):
+            mismatches.append("ALU0/ALU1: " + ", ".join(joinRegisters(i) for i in resB[ALU0:MULT]) +
+                              " != " + ", ".join(joinRegisters(i) for i in refB[ALU0:MULT]))
+        slots = range(MULT, len(resB))
+    for iLoc in slots:
+        if resB[iLoc][0] != refB[iLoc][0]:
+            mismatches.append(slotToStr[iLoc] + ": " + joinRegisters(resB[iLoc]) + " != " + joinRegisters(refB[iLoc]))
+    if len(mismatches) == 0:
+        return "Registers at bundle " + str(bLoc) + " cannot be renamed consistently with the other bundles: " + \
+               ", ".join(joinRegisters(i) for i in resB) + " != " + ", ".join(joinRegisters(i) for i in refB)
+    return "Instruction do not match modulo renaming at bundle " + str(bLoc) + ", instruction slot " + "; ".join(mismatches)
+
+def bundleVariants(resB, refB):
+    # the assignments of a result bundle to try against the reference one; the
+    # ALUs are interchangeable, so the swapped one too if it differs
+    if len(resB) != len(refB):
+        return []
+    if len(resB) == 5 and resB[ALU0] != resB[ALU1]:
+        return [resB, (resB[ALU1], resB[ALU0]) + resB[MULT:]]
+    return [resB]
+
+def diffRenamed(res, ref):
+    # Same as `diff`, on schedules canonicalized by `canonicalizeRenamed`.
+    # Whether the ALU slots of a bundle are swapped may only show in a later
+    # bundle, so the assignments are searched depth-first, backtracking to the
+    # last bundle with an untried one, at most SEARCH_STEPS times per bundle.
+    # A bundle that cannot be matched is reported, and the search goes on
+    # after it from the bindings of the longest match.
+    errors = []
+    if len(res) != len(ref):
+        errors.append("Schedule length does not match: " + str(len(res)) + " != " + str(len(ref)) + ".")
+
+    pairs = list(zip(res, ref))
+    renaming = RegisterRenaming()
+    budget = SEARCH_STEPS * len(pairs)
+    start = 0
+    while start < len(pairs):
+        startMark = len(renaming.journal)
+        stack = [] # (bundle, index of its next variant, journal mark)
+        deepest = None # the variants chosen in the longest match
+        bLoc, choice = start, 0
+        while bLoc < len(pairs):
+            variants = bundleVariants(*pairs[bLoc])
+            mark = len(renaming.journal)
+            matched = False
+            while choice < len(variants) and not matched:
+                matched = all(renaming.match(resI, refI) for resI, refI in zip(variants[choice], pairs[bLoc][1]))
+                if not matched:
+                    renaming.rollback(mark)
+                choice += 1
+            if matched:
+                stack.append((bLoc, choice, mark))
+                bLoc, choice = bLoc + 1, 0
+                continue
+
+            if deepest is None or len(stack) > len(deepest):
+                deepest = [c - 1 for _, c, _ in stack]
+            if not stack or budget == 0:
+                break
+            budget -= 1
+            bLoc, choice, mark = stack.pop()
+            renaming.rollback(mark)
+
+        if bLoc == len(pairs):
+            break
+        # replay the longest match and skip the bundle after it
+        renaming.rollback(startMark)
+        for offset, choice in enumerate(deepest):
+            resB, refB = pairs[start + offset]
+            assert all(renaming.match(resI, refI) for resI, refI in zip(bundleVariants(resB, refB)[choice], refB))
+        failed = start + len(deepest)
+        errors.append(describeRenamedBundle(*pairs[failed], failed))
+        start = failed + 1
+
+    return errors
+
+def describeBundle(resB, refB, bLoc):
+    if len(resB) != len(refB):
+        return "Bundle length does not match at bundle " + str(bLoc) + "."
+
+    mismatches = []
+    if resB[ALU0:MULT] != refB[ALU0:MULT]:
+        mismatches.append("ALU0/ALU1: " + ", ".join(resB[ALU0:MULT]) + " != " + ", ".join(refB[ALU0:MULT]))
+    for iLoc in range(MULT, len(resB)):
+        if resB[iLoc] != refB[iLoc]:
+            mismatches.append(slotToStr[iLoc] + ": " + resB[iLoc] + " != " + refB[iLoc])
+
+    return "Instruction do not match at bundle " + str(bLoc) + ", instruction slot " + "; ".join(mismatches)
+
+def diff(res, ref):
+    # compare two canonicalized schedules, returning every difference
+    errors = []
+    if len(res) != len(ref):
+        errors.append("Schedule length does not match: " + str(len(res)) + " != " + str(len(ref)) + ".")
+
+    for bLoc, (resB, refB) in enumerate(zip(res, ref)):
+        if resB != refB:
+            errors.append(describeBundle(resB, refB, bLoc))
+
+    return errors
+
+def compare(resF, refF, rename=False):
+    if rename:
+        errors = diffRenamed(canonicalizeRenamed(resF), canonicalizeRenamed(refF))
+    else:
+        errors = diff(canonicalize(resF), canonicalize(refF))
+
+    if len(errors) == 0:
+        return GREEN + "PASSED!" + RESET
+
+    return "\n".join(RED + error + RESET for error in errors)
+
+def loadJSON(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compareAgainstRefs(resPath, refPaths, rename=False):
+    # A test passes if the result matches any of its references. The result is
+    # canonicalized once and shared by all of them.
+    if not os.path.exists(resPath):
+        return False, [resPath + " does not exist."]
+
+    canonical, compareFn = (canonicalizeRenamed, diffRenamed) if rename else (canonicalize, diff)
+    res = canonical(loadJSON(resPath))
+    errors = []
+    for refPath in refPaths:
+        refErrors = compareFn(res, canonical(loadJSON(refPath)))
+        if len(refErrors) == 0:
+            return True, []
+        errors += [os.path.basename(refPath) + ": " + error for error in refErrors]
+
+    return False, errors
+
+def runSuite(folder, rename=False):
+    allPassed = True
+    for test in sorted(glob.glob(os.path.join(folder, "*"))):
+        if not os.path.isdir(test):
+            continue
+
+        loopPassed, loopErrors = compareAgainstRefs(os.path.join(test, "simple.json"),
+                                                    sorted(glob.glob(os.path.join(test, "simple_ref*.json"))), rename)
+        pipPassed, pipErrors = compareAgainstRefs(os.path.join(test, "pip.json"),
+                                                  sorted(glob.glob(os.path.join(test, "pip_ref*.json"))), rename)
+        allPassed = allPassed and loopPassed and pipPassed
+
+        with open(os.path.join(test, "desc.txt")) as f:
+            print(f.read().rstrip("\n"))
+        loopColor = GREEN if loopPassed else RED
+        pipColor = GREEN if pipPassed else RED
+        print("passed loop:  " + loopColor + str(loopPassed).lower() + RESET +
+              " passed pip: " + pipColor + str(pipPassed).lower() + RESET)
+        for error in loopErrors:
+            print("  loop schedule: " + RED + error + RESET)
+        for error in pipErrors:
+            print("  loop.pip schedule: " + RED + error + RESET)
+        print()
+
+    return allPassed
 
 args = parser.parse_args()
 
+if(args.suite is not None):
+    if not runSuite(args.suite, args.rename):
+        sys.exit(1)
+
 if(args.loop is not None):
     LOOP = json.load(args.loop)
     REFLOOP = json.load(args.refLoop)
-    simpleFull = compare(LOOP, REFLOOP)
+    simpleFull = compare(LOOP, REFLOOP, args.rename)
     print("loop schedule: " + simpleFull)
 
 if(args.pip is not None):
     PIP = json.load(args.pip)
     REFPIP = json.load(args.refPip)
-    pipFull = compare(PIP, REFPIP)
+    pipFull = compare(PIP, REFPIP, args.rename)
     print("loop.pip schedule: " + pipFull)
-
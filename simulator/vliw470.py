@@ -2,6 +2,16 @@
 
 import json
 import argparse
+import itertools
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -16,8 +26,77 @@ parser.add_argument(
     "--memory", type=argparse.FileType("r"),
     help="Optional data memory JSON initialization file."
 )
+parser.add_argument(
+    "--fast", action="store_true",
+    help="Fast-forward the steady state of loops. No per-cycle trace is " \
+         "recorded; only the final state is written to the result file."
+)
+parser.add_argument(
+    "--counters", type=argparse.FileType("w"),
+    help="Optional output file for the performance counters summary."
+)
+parser.add_argument(
+    "--histogram", action="store_true",
+    help="Include a per-PC histogram in the performance counters summary."
+)
+parser.add_argument(
+    "--chunked", action="store_true",
+    help="Write the trace as a header with a per-cycle offset index, then " \
+         "keyframes and deltas, so that the visualizer loads long traces lazily."
+)
+parser.add_argument(
+    "--keyframe", type=int, default=64,
+    help="Cycles between two full states of a --chunked trace."
+)
+parser.add_argument(
+    "--checkpoint",
+    help="Binary file the machine state is saved to, by --checkpoint-every, " \
+         "--pause-at or an interrupt (Ctrl-C), to be continued with --resume."
+)
+parser.add_argument(
+    "--checkpoint-every", type=int,
+    help="Save a checkpoint every N cycles."
+)
+parser.add_argument(
+    "--pause-at", type=int,
+    help="Save a checkpoint and stop at cycle N."
+)
+parser.add_argument(
+    "--resume", type=argparse.FileType("rb"),
+    help="Continue from a checkpoint of the same program. The trace only " \
+         "covers the cycles from there on; the counters cover the whole run."
+)
+parser.add_argument(
+    "--mem-trace",
+    help="Output file for a record of every ld/st issued: cycle, PC, " \
+         "address, load or store and whether it was predicated off."
+)
+parser.add_argument(
+    "--mem-trace-format", choices=["binary", "ndjson"], default="binary",
+    help="Fixed-size binary records (the default) or one JSON object per line."
+)
+parser.add_argument(
+    "--mem-stats", type=argparse.FileType("w"),
+    help="Optional output file for the memory access statistics: strides " \
+         "per PC, reuse distances and working set per loop iteration."
+)
+parser.add_argument(
+    "--max-cycles", type=int,
+    help="Stop with an error after N cycles."
+)
+parser.add_argument(
+    "--timeout", type=float,
+    help="Stop with an error after N seconds."
+)
+parser.add_argument(
+    "--diagnostic", type=argparse.FileType("w"),
+    help="Where to write the diagnostic of a stop by --max-cycles, " \
+         "--timeout or a loop making no progress, instead of stderr."
+)
 
 arg = parser.parse_args()
+if (arg.checkpoint_every or arg.pause_at is not None) and not arg.checkpoint:
+    parser.error("--checkpoint-every and --pause-at need --checkpoint")
 
 instructionMemory: list[list[str]] = json.load(arg.instructions)
 
@@ -45,7 +124,317 @@ if arg.memory:
 else:
     dataMemory = DataMemory({})
 
-state = []
+class ChunkedTrace:
+    # The trace of --chunked: a header line, then one line per cycle, all
+    # compact JSON. Every `keyframe` cycles the line holds the full state
+    # ({"state": ...}); in between, only what changed since the previous
+    # cycle ({"set": {field: value}, "patch": {array or memory: {idx: value}}}).
+    # The header gives the byte offset of each line from the end of the
+    # header, so a reader can load the cycles [n - n % keyframe, n] alone.
+    # Lines are buffered in a temporary file: only the last state is kept.
+    PATCHED = ["PhysicalRegisterFile", "PredicateRegisters", "MemoryData"]
+
+    def __init__(self, keyframe: int):
+        self.keyframe = keyframe
+        self.data = tempfile.TemporaryFile("w+")
+        self.offsets = []
+        self.size = 0
+        self.previous = None
+
+    def append(self, current: dict):
+        if len(self.offsets) % self.keyframe == 0:
+            record = {"state": current}
+        else:
+            record = {"set": {}, "patch": {}}
+            for key, value in current.items():
+                if key in self.PATCHED:
+                    old = self.previous[key]
+                    indices = value.keys() if isinstance(value, dict) else range(len(value))
+                    patch = {str(i): value[i] for i in indices if i not in old or old[i] != value[i]} \
+                            if isinstance(value, dict) else \
+                            {str(i): value[i] for i in indices if old[i] != value[i]}
+                    if patch:
+                        record["patch"][key] = patch
+                elif value != self.previous[key]:
+                    record["set"][key] = value
+        line = json.dumps(record, separators=(",", ":")) + "\n" # ASCII, so characters are bytes
+        self.offsets.append(self.size)
+        self.size += len(line)
+        self.data.write(line)
+        self.previous = current
+
+    def dump(self, f):
+        header = {"format": "vliw470-trace", "version": 1, "cycles": len(self.offsets),
+                  "keyframe": self.keyframe, "size": self.size, "offsets": self.offsets}
+        f.write(json.dumps(header, separators=(",", ":")) + "\n")
+        self.data.seek(0)
+        shutil.copyfileobj(self.data, f)
+
+
+state = ChunkedTrace(arg.keyframe) if arg.chunked else []
+
+
+class Checkpoint:
+    # A checkpoint is a header (magic, version and the CRC32 of the program,
+    # so that it is not resumed with another one), then the zlib-compressed
+    # machine state as zigzag varints: cycles, PC, RBB, LC, EC, the register
+    # and predicate files, the in-flight multiplier entries, the data memory
+    # as (address delta, value) pairs and the performance counters.
+    # Checkpoints are only taken between two cycles, when the other pipes
+    # hold nothing that has not been executed yet.
+    HEADER = struct.Struct("<8sHI")
+    MAGIC = b"VLIW470C"
+    VERSION = 1
+
+    @staticmethod
+    def program() -> int:
+        return zlib.crc32(json.dumps(instructionMemory).encode())
+
+    @staticmethod
+    def encode(values) -> bytes:
+        out = bytearray()
+        for value in values:
+            value = int(value)
+            value = value << 1 if value >= 0 else ((-value) << 1) - 1
+            while value >= 0x80:
+                out.append(value & 0x7F | 0x80)
+                value >>= 7
+            out.append(value)
+        return bytes(out)
+
+    @staticmethod
+    def decode(data: bytes):
+        value = shift = 0
+        for byte in data:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            yield (value >> 1) if not value & 1 else -((value + 1) >> 1)
+            value = shift = 0
+
+    @classmethod
+    def save(cls, processor, path: str):
+        values = [processor.cycles, processor.PC, processor.RBB, processor.LC, processor.EC]
+        values += processor.PhysicalRegisterFile
+        values += processor.PredicateRegisters
+        values.append(len(processor.MultiplierPipe))
+        for item in processor.MultiplierPipe:
+            values += [item["predicate"], item["targetReg"], item["result"]]
+        values.append(len(dataMemory.data))
+        previous = 0
+        for addr, data in sorted(dataMemory.data.items()):
+            values += [addr - previous, data]
+            previous = addr
+        values.append(len(processor.issueCount))
+        for pc, count in sorted(processor.issueCount.items()):
+            values += [pc, count]
+        values.append(len(processor.predicatedOff))
+        for pc, off in sorted(processor.predicatedOff.items()):
+            values += [pc] + off
+
+        # write a temporary file first, so an interrupted save keeps the previous checkpoint
+        with open(path + ".tmp", "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.program()))
+            f.write(zlib.compress(cls.encode(values)))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, processor, f):
+        data = f.read()
+        if len(data) < cls.HEADER.size:
+            raise ValueError("{} is not a checkpoint".format(f.name))
+        magic, version, program = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("{} is not a version {} checkpoint".format(f.name, cls.VERSION))
+        if program != cls.program():
+            raise ValueError("{} is a checkpoint of another program".format(f.name))
+        values = cls.decode(zlib.decompress(data[cls.HEADER.size:]))
+
+        def take(n: int) -> list:
+            taken = list(itertools.islice(values, n))
+            if len(taken) < n:
+                raise ValueError("{} is truncated".format(f.name))
+            return taken
+        length = lambda: take(1)[0]
+
+        processor.cycles, processor.PC, processor.RBB, processor.LC, processor.EC = take(5)
+        processor.PhysicalRegisterFile[:] = take(96)
+        processor.PredicateRegisters[:] = [p != 0 for p in take(96)]
+        processor.MultiplierPipe[:] = [
+            {"predicate": p != 0, "targetReg": t, "result": r}
+            for p, t, r in [take(3) for _ in range(length())]
+        ]
+        dataMemory.data.clear()
+        addr = 0
+        for _ in range(length()):
+            delta, data = take(2)
+            addr += delta
+            dataMemory.data[addr] = data
+        processor.issueCount.clear()
+        for _ in range(length()):
+            pc, count = take(2)
+            processor.issueCount[pc] = count
+        processor.predicatedOff.clear()
+        for _ in range(length()):
+            pc, *off = take(6)
+            processor.predicatedOff[pc] = off
+
+
+class MemoryTrace:
+    # Records the ld/st issued, to `path` as a header (magic, version) and
+    # then one RECORD per access (cycle, PC, address as unsigned 64-bit,
+    # flags: 1 for a store, 2 if executed), or as NDJSON. With `stats`,
+    # also accounts for the executed accesses:
+    # * the stride between two consecutive accesses of the same PC, up to
+    #   STRIDES distinct strides per PC, the others being counted as "other"
+    # * the reuse distance, i.e. the number of distinct addresses accessed
+    #   since the previous access to the same one, by powers of two. The
+    #   last access to every address is marked in a Fenwick tree indexed by
+    #   time, so a distance is the number of marks in between; times are
+    #   renumbered when the tree is full, so it grows with the footprint
+    #   rather than the run.
+    # * the distinct addresses accessed by the loop body in each iteration,
+    #   an iteration ending when the bundle of the loop instruction issues.
+    HEADER = struct.Struct("<8sH")
+    MAGIC = b"VLIW470M"
+    VERSION = 1
+    RECORD = struct.Struct("<QIQB")
+    STRIDES = 32
+
+    def __init__(self, path: str, format: str, stats: bool, kernel: tuple):
+        self.out = None
+        if path:
+            self.out = open(path, "wb" if format == "binary" else "w", buffering=1 << 20)
+            if format == "binary":
+                self.out.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        self.binary = format == "binary"
+        self.stats = stats
+
+        self.loads = 0
+        self.stores = 0
+        self.predicatedOff = 0
+        self.lastAddress = {} # PC -> address of its last access
+        self.strides = {} # PC -> stride -> count
+        self.time = 0
+        self.lastAccess = {} # address -> time of its last access
+        self.tree = [0] * 1025
+        self.reuse = {} # bucket -> count, None for the first accesses
+
+        self.kernel = kernel # first and last bundles of the loop body, or None
+        self.iteration = set()
+        self.workingSets = {} # number of addresses -> number of iterations
+
+    def access(self, cycle: int, pc: int, address: int, store: bool, executed: bool):
+        if self.out is not None:
+            if self.binary:
+                self.out.write(self.RECORD.pack(cycle, pc, address & 0xFFFFFFFFFFFFFFFF, store | executed << 1))
+            else:
+                self.out.write('{{"cycle":{},"pc":{},"address":{},"op":"{}","predicate":{}}}\n'.format(
+                    cycle, pc, address, "st" if store else "ld", "true" if executed else "false"))
+        if not executed:
+            self.predicatedOff += 1
+            return
+        if store:
+            self.stores += 1
+        else:
+            self.loads += 1
+        if not self.stats:
+            return
+
+        if pc in self.lastAddress:
+            strides = self.strides.setdefault(pc, {})
+            stride = address - self.lastAddress[pc]
+            if stride not in strides and len(strides) >= self.STRIDES:
+                stride = "other"
+            strides[stride] = strides.get(stride, 0) + 1
+        self.lastAddress[pc] = address
+
+        if self.time + 1 >= len(self.tree):
+            self.renumber()
+        last = self.lastAccess.get(address)
+        if last is None:
+            bucket = None
+        else:
+            # every address has its mark before now
+            distance = len(self.lastAccess) - self.marks(last + 1)
+            bucket = 0 if distance == 0 else 1 << (distance.bit_length() - 1)
+            self.mark(last, -1)
+        self.reuse[bucket] = self.reuse.get(bucket, 0) + 1
+        self.mark(self.time, 1)
+        self.lastAccess[address] = self.time
+        self.time += 1
+
+        if self.kernel is not None and self.kernel[0] <= pc <= self.kernel[1]:
+            self.iteration.add(address)
+
+    def issued(self, pc: int):
+        # the bundle at `pc` has issued, after its access if any
+        if self.stats and self.kernel is not None and pc == self.kernel[1]:
+            size = len(self.iteration)
+            self.workingSets[size] = self.workingSets.get(size, 0) + 1
+            self.iteration.clear()
+
+    def mark(self, time: int, delta: int):
+        tree = self.tree
+        size = len(tree)
+        i = time + 1
+        while i < size:
+            tree[i] += delta
+            i += i & -i
+
+    def marks(self, time: int) -> int:
+        # number of marks before `time`
+        total = 0
+        while time > 0:
+            total += self.tree[time]
+            time -= time & -time
+        return total
+
+    def renumber(self):
+        # keep the order of the last accesses, with times 0..n-1
+        order = sorted(self.lastAccess, key=self.lastAccess.get)
+        for time, address in enumerate(order):
+            self.lastAccess[address] = time
+        self.time = len(order)
+
+        # the tree of marks at 0..n-1, built in linear time
+        size = max(1024, 4 * len(order)) + 1
+        tree = [0] * size
+        tree[1:len(order) + 1] = [1] * len(order)
+        for i in range(1, size):
+            j = i + (i & -i)
+            if j < size:
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+
+    def summary(self) -> dict:
+        iterations = sum(self.workingSets.values())
+        return {
+            "loads": self.loads,
+            "stores": self.stores,
+            "predicatedOff": self.predicatedOff,
+            "footprint": len(self.lastAccess),
+            "strides": {
+                pc: {str(stride): count for stride, count in sorted(strides.items(), key=lambda item: -item[1])}
+                for pc, strides in sorted(self.strides.items())
+            },
+            "reuseDistance": {
+                ("cold" if bucket is None else str(bucket)): self.reuse[bucket]
+                for bucket in sorted(self.reuse, key=lambda bucket: -1 if bucket is None else bucket)
+            },
+            "iterations": iterations,
+            "workingSet": {
+                "min": min(self.workingSets, default=0),
+                "max": max(self.workingSets, default=0),
+                "mean": round(sum(size * count for size, count in self.workingSets.items()) / iterations, 4) if iterations else 0,
+                "histogram": {str(size): count for size, count in sorted(self.workingSets.items())},
+            },
+        }
 
 
 class VLIW470:
@@ -121,6 +510,22 @@ class VLIW470:
             "MemoryData": dataMemory.data.copy()
         }
 
+    # Record the state of every cycle in `state`.
+    trace = True
+
+    # Pre-decoded bundles used by `fastForward`, indexed by PC.
+    _decoded = {}
+
+    # Performance counters. Everything else in the summary is derived from
+    # how often each bundle was issued and which of its slots were
+    # predicated off, see `counters`.
+    cycles = 0
+    issueCount = {} # PC -> number of times the bundle was issued
+    predicatedOff = {} # PC -> number of predicated-off ops per slot
+
+    # Record of the memory accesses, if any.
+    memTrace = None
+
     _debug_currentCycleUpdate = []
 
     def updateRegister(self, name: str, value: int):
@@ -415,7 +820,22 @@ class VLIW470:
         self.BranchPipe = self.decodeBrancInstruction(inst[4])
 
         # record the state
-        state.append(self.serialize())
+        if self.trace:
+            state.append(self.serialize())
+
+        # update the performance counters
+        self.cycles += 1
+        if self.PC < len(instructionMemory):
+            self.issueCount[self.PC] = self.issueCount.get(self.PC, 0) + 1
+            pipes = [self.ALU0Pipe, self.ALU1Pipe, self.MultiplierPipe[0], self.MemoryPipe, self.BranchPipe]
+            for slot, pipe in enumerate(pipes):
+                if not pipe["predicate"] and inst[slot].strip() != "nop":
+                    self.predicatedOff.setdefault(self.PC, [0] * 5)[slot] += 1
+            if self.memTrace is not None:
+                if inst[3].strip() != "nop":
+                    self.memTrace.access(self.cycles - 1, self.PC, self.MemoryPipe["address"],
+                                         self.MemoryPipe["opcode"] == "store", self.MemoryPipe["predicate"])
+                self.memTrace.issued(self.PC)
 
         # Now start latch other data structures.
         ## Execution Stage
@@ -477,35 +897,388 @@ class VLIW470:
             elif self.BranchPipe["opcode"] == "hw":
                 if self.LC > 0:
                     self.updateRegister("LC", self.LC - 1)
-                    self.updateRegister("RBB", self.RBB + 1)
+                    self.updateRegister("RBB", (self.RBB + 1) % 64)
                     self.updateRegister("p{}".format(self.renameRegister(32)), 1)
                     self.PC = self.BranchPipe["targetPC"]
                 elif self.EC > 0:
                     self.updateRegister("EC", self.EC - 1)
-                    self.updateRegister("RBB", self.RBB + 1)
+                    self.updateRegister("RBB", (self.RBB + 1) % 64)
                     self.updateRegister("p{}".format(self.renameRegister(32)), 0)
                     self.PC = self.BranchPipe["targetPC"]
                 else:
                     self.updateRegister("p{}".format(self.renameRegister(32)), 0)
 
+    def predecode(self, pc: int):
+        # Decode a bundle once into (slot, predicate, opcode, operands...)
+        # tuples holding logical register indices, so that the fast path does
+        # not need to parse strings every cycle. Returns None if the bundle
+        # contains anything the fast path does not handle.
+        def reg(op: str) -> int:
+            assert op.startswith('x'), "Cannot determine the register: {}".format(op)
+            return int(op[1:])
+
+        ops = []
+        for slot, i in enumerate(instructionMemory[pc]):
+            info = i.split()
+            predicate = None
+            if info[0].startswith("(") and info[0].endswith(")"):
+                predicate = int(info[0][2:-1].strip())
+                info.remove(info[0])
+            opcode = info[0]
+            operands = [item.strip().rstrip(",").strip() for item in info[1:]]
+
+            if opcode == "nop":
+                continue
+            elif opcode in ["add", "sub", "mulu"]:
+                ops.append((slot, predicate, opcode, reg(operands[0]), reg(operands[1]), reg(operands[2])))
+            elif opcode == "addi":
+                ops.append((slot, predicate, opcode, reg(operands[0]), reg(operands[1]), int(operands[2])))
+            elif opcode == "mov":
+                if operands[0].startswith("p") and operands[1] in ["true", "false"]:
+                    ops.append((slot, predicate, "movp", int(operands[0][1:]), int(operands[1] == "true"), None))
+                elif operands[0].startswith("x") and operands[1].startswith("x"):
+                    ops.append((slot, predicate, "movr", reg(operands[0]), reg(operands[1]), None))
+                elif operands[0].startswith("x"):
+                    ops.append((slot, predicate, "movi", reg(operands[0]), self.parseImmediate(operands[1]), None))
+                else:
+                    return None # LC, EC or RBB updates break the regular control flow
+            elif opcode in ["ld", "st"]:
+                imm = operands[1].split("(")[0].strip()
+                imm = self.parseImmediate(imm) if len(imm) > 0 else 0
+                base = reg(operands[1].split("(")[1].strip()[:-1])
+                ops.append((slot, predicate, opcode, reg(operands[0]), base, imm))
+            elif opcode in ["loop", "loop.pip"]:
+                ops.append((slot, predicate, opcode, int(operands[0]), None, None))
+            else:
+                return None
+        return ops
+
+    def fastForward(self, start: int, end: int, limit: int = None) -> int:
+        # Run whole iterations of the loop spanning bundles `start`..`end` from
+        # pre-decoded bundles, with the same semantics as `tick`. Must be
+        # called with PC == start, once the loop branch has been taken at least
+        # once through `tick`. Stops at the beginning of the iteration in
+        # which LC reaches 0, so the last iteration and the epilogue (EC
+        # draining for `loop.pip`) are stepped exactly by `tick`, or after
+        # `limit` cycles. Returns the number of cycles executed.
+        bundles = []
+        for pc in range(start, end + 1):
+            if pc not in self._decoded:
+                self._decoded[pc] = self.predecode(pc)
+            ops = self._decoded[pc]
+            if ops is None:
+                return 0
+            # the only branch of the loop must be the backward one at `end`
+            for op in ops:
+                if op[2] in ["loop", "loop.pip"] and (pc != end or op[3] != start):
+                    return 0
+            bundles.append(ops)
+
+        regs = self.PhysicalRegisterFile
+        preds = self.PredicateRegisters
+        memory = dataMemory.data
+        mulPipe = [(item["predicate"], item["targetReg"], item["result"]) for item in self.MultiplierPipe]
+        rbb = self.RBB
+        lc = self.LC
+        ec = self.EC
+        pc = start
+        cycles = 0
+        issueCount = self.issueCount
+        predicatedOff = self.predicatedOff
+        memTrace = self.memTrace
+
+        def rename(idx: int) -> int:
+            if idx >= 32:
+                potential = idx - rbb
+                if potential < 32:
+                    return potential + 64
+                return potential
+            return idx
+
+        while start <= pc <= end and not (pc == start and lc == 0) and (limit is None or cycles < limit):
+            # read stage: every operand is read before any register is written
+            writes = []
+            mulEntry = (False, 0, 0)
+            memOp = None
+            branch = None
+            issueCount[pc] = issueCount.get(pc, 0) + 1
+            for slot, predicate, opcode, a, b, c in bundles[pc - start]:
+                valid = predicate is None or preds[rename(predicate)]
+                if not valid:
+                    predicatedOff.setdefault(pc, [0] * 5)[slot] += 1
+                if opcode == "add":
+                    if valid:
+                        writes.append((False, rename(a), (regs[rename(b)] + regs[rename(c)]) & 0xFFFFFFFFFFFFFFFF))
+                elif opcode == "sub":
+                    if valid:
+                        writes.append((False, rename(a), (regs[rename(b)] - regs[rename(c)]) & 0xFFFFFFFFFFFFFFFF))
+                elif opcode == "addi":
+                    if valid:
+                        writes.append((False, rename(a), (regs[rename(b)] + c) & 0xFFFFFFFFFFFFFFFF))
+                elif opcode == "movr":
+                    if valid:
+                        writes.append((False, rename(a), regs[rename(b)]))
+                elif opcode == "movi":
+                    if valid:
+                        writes.append((False, rename(a), b))
+                elif opcode == "movp":
+                    if valid:
+                        writes.append((True, rename(a), b))
+                elif opcode == "mulu":
+                    mulEntry = (valid, rename(a), (regs[rename(b)] * regs[rename(c)]) & 0xFFFFFFFFFFFFFFFF)
+                elif opcode == "ld":
+                    if valid:
+                        memOp = (opcode, rename(a), regs[rename(b)] + c)
+                    if memTrace is not None:
+                        memTrace.access(self.cycles + cycles, pc, regs[rename(b)] + c, False, valid)
+                elif opcode == "st":
+                    if valid:
+                        memOp = (opcode, regs[rename(a)], regs[rename(b)] + c)
+                    if memTrace is not None:
+                        memTrace.access(self.cycles + cycles, pc, regs[rename(b)] + c, True, valid)
+                else:
+                    if valid:
+                        branch = opcode
+
+            # execution stage
+            for isPredicate, idx, value in writes:
+                if isPredicate:
+                    preds[idx] = value != 0
+                else:
+                    regs[idx] = value
+            if memOp is not None:
+                if memOp[0] == "ld":
+                    regs[memOp[1]] = memory.get(memOp[2], 0)
+                else:
+                    memory[memOp[2]] = memOp[1]
+            mulPipe.insert(0, mulEntry)
+            valid, idx, value = mulPipe.pop()
+            if valid:
+                regs[idx] = value
+            if memTrace is not None:
+                memTrace.issued(pc)
+
+            cycles += 1
+            pc += 1
+            if branch == "loop":
+                if lc > 0:
+                    lc -= 1
+                    pc = start
+            elif branch == "loop.pip":
+                if lc > 0:
+                    lc -= 1
+                    rbb = (rbb + 1) % 64
+                    preds[rename(32)] = True
+                    pc = start
+                elif ec > 0:
+                    ec -= 1
+                    rbb = (rbb + 1) % 64
+                    preds[rename(32)] = False
+                    pc = start
+                else:
+                    preds[rename(32)] = False
+
+        self.MultiplierPipe[:] = [{"predicate": p, "targetReg": t, "result": r} for p, t, r in mulPipe]
+        self.PC = pc
+        self.RBB = rbb
+        self.LC = lc
+        self.EC = ec
+        self.cycles += cycles
+        return cycles
+
+    def fingerprint(self) -> int:
+        # Hash of everything that determines the following cycles. The
+        # simulation is deterministic, so if it comes back to a state, it
+        # cycles through the same states forever.
+        return hash((
+            self.PC, self.RBB, self.LC, self.EC,
+            tuple(self.PhysicalRegisterFile), tuple(self.PredicateRegisters),
+            tuple((item["predicate"], item["targetReg"], item["result"]) for item in self.MultiplierPipe),
+            frozenset(dataMemory.data.items()),
+        ))
+
+    def kernel(self) -> tuple:
+        # The first and last bundles of the loop, None without a loop.
+        kernel = None
+        for pc, bundle in enumerate(instructionMemory):
+            opcode = self.parse(bundle[4])["opcode"]
+            if opcode in ["loop", "loop.pip"]:
+                kernel = (int(self.parse(bundle[4])["operands"][0]), pc)
+        return kernel
+
+    def counters(self, histogram: bool = False) -> dict:
+        # Summarize the performance counters. The prologue, kernel and
+        # epilogue are the bundles before, within and after the range of the
+        # `loop`/`loop.pip` instruction; cycles spent after the end of the
+        # program draining the pipelines count towards the epilogue.
+        units = ["ALU0", "ALU1", "Mult", "Mem", "Branch"]
+        kernel = self.kernel()
+
+        issued = [0] * 5
+        off = [0] * 5
+        nops = 0
+        bundles = 0
+        regions = {"prologue": 0, "kernel": 0, "epilogue": 0}
+        perPC = {}
+        for pc, count in sorted(self.issueCount.items()):
+            used = [self.parse(i)["opcode"] != "nop" for i in instructionMemory[pc]]
+            predicatedOff = self.predicatedOff.get(pc, [0] * 5)
+            for slot in range(5):
+                issued[slot] += count * used[slot]
+                off[slot] += predicatedOff[slot]
+            nops += count * used.count(False)
+            bundles += count
+            if kernel is None or pc > kernel[1]:
+                regions["epilogue"] += count
+            elif pc < kernel[0]:
+                regions["prologue"] += count
+            else:
+                regions["kernel"] += count
+            perPC[pc] = {
+                "issued": count,
+                "ops": used.count(True),
+                "predicatedOff": sum(predicatedOff),
+            }
+        regions["epilogue"] += self.cycles - bundles
+
+        executed = sum(issued) - sum(off)
+        summary = {
+            "cycles": self.cycles,
+            "bundles": bundles,
+            "ops": executed,
+            "nops": nops,
+            "predicatedOff": sum(off),
+            "ipc": round(executed / self.cycles, 4) if self.cycles else 0,
+            "units": {
+                unit: {
+                    "issued": issued[slot],
+                    "predicatedOff": off[slot],
+                    "utilization": round((issued[slot] - off[slot]) / self.cycles, 4) if self.cycles else 0,
+                } for slot, unit in enumerate(units)
+            },
+            "loopIterations": self.issueCount.get(kernel[1], 0) if kernel is not None else 0,
+            "prologueCycles": regions["prologue"],
+            "kernelCycles": regions["kernel"],
+            "epilogueCycles": regions["epilogue"],
+        }
+        if histogram:
+            summary["histogram"] = perPC
+        return summary
+
         
 
 
 def main():
     processor = VLIW470()
 
+    processor.trace = not arg.fast
+    if arg.mem_trace or arg.mem_stats:
+        processor.memTrace = MemoryTrace(arg.mem_trace, arg.mem_trace_format, arg.mem_stats is not None, processor.kernel())
+
+    if arg.resume:
+        try:
+            Checkpoint.load(processor, arg.resume)
+        except (ValueError, zlib.error) as e:
+            parser.error("cannot resume: {}".format(e))
+
+    # Ctrl-C stops at the end of the cycle, with a checkpoint; a second one kills
+    interrupted = []
+    if arg.checkpoint:
+        def interrupt(signum, frame):
+            interrupted.append(signum)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, interrupt)
+    lastCheckpoint = processor.cycles
+
+    # Watchdog: a loop iteration that decrements neither LC nor EC makes no
+    # progress; the state at the end of such iterations is remembered (up to
+    # `NO_PROGRESS_STATES` of them), and seeing one again means an endless loop.
+    NO_PROGRESS_STATES = 4096
+    start = time.monotonic()
+    recentPCs = deque(maxlen=16)
+    noProgress = {} # fingerprint -> cycle
+    counts = None # (LC, EC) after the last taken backward branch
+    stop = None
+
     # In the main loop, let's see what happens
     while True:
+        if interrupted or (arg.pause_at is not None and processor.cycles >= arg.pause_at):
+            Checkpoint.save(processor, arg.checkpoint)
+            print("Stopped at cycle {}, resume with --resume {}".format(processor.cycles, arg.checkpoint))
+            break
+        if arg.max_cycles is not None and processor.cycles >= arg.max_cycles:
+            stop = {"reason": "max-cycles"}
+            break
+        if arg.timeout is not None and time.monotonic() - start >= arg.timeout:
+            stop = {"reason": "timeout"}
+            break
+        if arg.checkpoint_every and processor.cycles - lastCheckpoint >= arg.checkpoint_every:
+            Checkpoint.save(processor, arg.checkpoint)
+            lastCheckpoint = processor.cycles
+
+        pc = processor.PC
+        recentPCs.append(pc)
         processor.tick()
 
+        if processor.PC <= pc < len(instructionMemory):
+            # a backward branch has been taken
+            if counts is not None and processor.LC >= counts[0] and processor.EC >= counts[1]:
+                fingerprint = processor.fingerprint()
+                if fingerprint in noProgress:
+                    stop = {"reason": "no-progress", "repeats": noProgress[fingerprint]}
+                    break
+                if len(noProgress) < NO_PROGRESS_STATES:
+                    noProgress[fingerprint] = processor.cycles
+            counts = (processor.LC, processor.EC)
+
+            if arg.fast:
+                # the loop is in steady state; stop fast-forwarding at the
+                # cycles checked above, and now and then for the timeout
+                limits = [c - processor.cycles for c in (arg.pause_at, arg.max_cycles) if c is not None]
+                if arg.timeout is not None:
+                    limits.append(1 << 16)
+                processor.fastForward(processor.PC, pc, min(limits, default=None))
+
         if processor.PC >= len(instructionMemory):
             # ok, now it's possible to see a stop. do two more cycles.
             processor.tick()
+            # with --fast, record the last cycle where the trace would, before its writeback
+            processor.trace = True
             processor.tick()
             break
         
+    if not processor.trace:
+        # stopped early: the state reached so far
+        state.append(processor.serialize())
+
     # Finally, dump the state to the file
-    json.dump(state, arg.result, indent=4)
+    if arg.chunked:
+        state.dump(arg.result)
+    else:
+        json.dump(state, arg.result, indent=4)
+
+    if arg.counters:
+        json.dump(processor.counters(arg.histogram), arg.counters)
+
+    if processor.memTrace is not None:
+        processor.memTrace.close()
+        if arg.mem_stats:
+            json.dump(processor.memTrace.summary(), arg.mem_stats)
+
+    if stop is not None:
+        stop.update({
+            "cycles": processor.cycles,
+            "seconds": round(time.monotonic() - start, 3),
+            "PC": processor.PC,
+            "bundle": instructionMemory[processor.PC] if processor.PC < len(instructionMemory) else None,
+            "LC": processor.LC,
+            "EC": processor.EC,
+            "RBB": processor.RBB,
+            "recentPCs": list(recentPCs),
+        })
+        json.dump(stop, arg.diagnostic or sys.stderr)
+        (arg.diagnostic or sys.stderr).write("\n")
+        sys.exit(1)
 
 
 
@@ -0,0 +1,155 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses        import asdict, replace
+from itertools          import product, repeat
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+from VLIW470 import VLIW470
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'simulator', 'vliw470.py')
+REGISTER = re.compile(r"(?<![0-9A-Za-z])x(\d+)") # a general purpose register, but not the x of a hex immediate
+SCHEDULES = ['simple', 'pip']
+
+
+def simulate(schedule: list[list[str]], memoryPath: str = None) -> tuple[int, dict]:
+    ''' number of cycles and final data memory of a schedule in the simulator,
+    starting from a zeroed memory if no image is given '''
+    with tempfile.TemporaryDirectory() as tmp:
+        programPath = os.path.join(tmp, 'program.json')
+        resultPath = os.path.join(tmp, 'result.json')
+        countersPath = os.path.join(tmp, 'counters.json')
+        with open(programPath, 'w') as f:
+            json.dump(schedule, f)
+        memory = ['--memory', memoryPath] if memoryPath is not None else []
+        subprocess.run([sys.executable, SIMULATOR, '--fast', *memory,
+                        '--counters', countersPath, programPath, resultPath],
+                       check=True, capture_output=True)
+        with open(countersPath) as f:
+            cycles = json.load(f)['cycles']
+        with open(resultPath) as f:
+            memory = json.load(f)[-1]['MemoryData']
+    return cycles, memory
+
+
+def evaluate(insts: list[str], options: VLIW470.Options, memoryPath: str = None) -> dict:
+    ''' compile `insts` with `options` and measure both schedules
+
+    Both schedules always run in the simulator, so that their final memory
+    can be checked. The cycles come from the simulator if a memory image is
+    given, from the static cycle model otherwise. Runs in a worker process, so
+    only plain data is returned.
+    '''
+    result = {'options': asdict(options), 'error': None}
+    try:
+        compiler = VLIW470(insts, options)
+        report = compiler.report()
+        for name, scheduler in zip(SCHEDULES, (compiler.simpleScheduler, compiler.pipelineScheduler)):
+            schedule = scheduler.to_list()
+            if any(int(idx) > 95 for bundle in schedule for inst in bundle for idx in REGISTER.findall(inst)):
+                raise ValueError(f'{name} schedule uses registers beyond x95')
+            cycles, memory = simulate(schedule, memoryPath)
+            if memoryPath is None:
+                cycles = report[name]['predictedCycles']
+            result[name] = {'schedule': schedule, 'cycles': cycles, 'memory': memory}
+    except Exception as e: # any candidate may fail, e.g. a loop that cannot be unrolled
+        result['error'] = f'{type(e).__name__}: {e}'
+    return result
+
+
+class Autotuner:
+    ''' search the scheduling options for the fastest schedules
+
+    Every combination of the values in `space` (a dict from a field of
+    `VLIW470.Options` to the list of values to try) is applied on top of
+    `options` and compiled in a pool of `jobs` worker processes. Candidates
+    are ranked by the cycles of each schedule; ties go to the earlier
+    candidate, the first one being `options` itself. A candidate is only
+    valid if both its schedules end, in the simulator, with the same data
+    memory as the reference: the loop.simple schedule of `options` with
+    `memDeps` and without unrolling. If the reference fails, no candidate is
+    valid.
+
+    Unless `space` lists `iiStart`, each candidate is also tried with the
+    loop.pip scheduler starting 1 to `II_STEPS` IIs above its resource bound.
+    '''
+
+    SPACE = {
+        'memDeps'   : [False, True],
+        'priority'  : ['order', 'height'],
+        'unroll'    : [1, 2, 4],
+        'compactPip': [False, True],
+    }
+    II_STEPS = 2
+
+    def __init__(self, insts: list[str], options: VLIW470.Options = None,
+                       space: dict = None, memoryPath: str = None, jobs: int = None) -> None:
+        self.insts = insts
+        self.options = options if options is not None else VLIW470.Options()
+        self.space = space if space is not None else self.SPACE
+        self.memoryPath = memoryPath
+        self.jobs = jobs
+        self.results: list[dict] = self._search()
+
+    def candidates(self) -> list[VLIW470.Options]:
+        ''' the options to try, starting with the base ones '''
+        keys = list(self.space.keys())
+        candidates = [self.options]
+        for values in product(*(self.space[key] for key in keys)):
+            candidate = replace(self.options, **dict(zip(keys, values)))
+            variants = [candidate]
+            if 'iiStart' not in self.space:
+                try:
+                    resMII = VLIW470(self.insts, candidate).resMII()
+                    variants += [replace(candidate, iiStart = resMII + step) for step in range(1, self.II_STEPS + 1)]
+                except Exception: # the candidate itself reports the error when evaluated
+                    pass
+            for variant in variants:
+                if variant not in candidates:
+                    candidates.append(variant)
+        return candidates
+
+    def reference(self) -> VLIW470.Options:
+        ''' the options whose loop.simple schedule defines the expected final memory '''
+        return replace(self.options, memDeps = True, unroll = 1)
+
+    def _search(self) -> list[dict]:
+        candidates = self.candidates() + [self.reference()]
+        args = (repeat(self.insts), candidates, repeat(self.memoryPath))
+        if self.jobs == 1:
+            results = list(map(evaluate, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(evaluate, *args))
+
+        reference = results.pop()
+        for result in results:
+            if result['error'] is not None:
+                continue
+            if reference['error'] is not None:
+                result['error'] = f'no reference memory, {reference["error"]}'
+                continue
+            for name in SCHEDULES:
+                if result[name]['memory'] != reference['simple']['memory']:
+                    result['error'] = f'{name} schedule ends with a different memory'
+        return results
+
+    def best(self, name: str) -> dict:
+        ''' the fastest valid candidate for schedule `name` ('simple' or 'pip') '''
+        valid = [result for result in self.results if result['error'] is None]
+        if not valid:
+            raise ValueError('No valid schedule found')
+        return min(valid, key=lambda result: result[name]['cycles'])
+
+    def report(self) -> dict:
+        ''' the chosen options of each schedule and all candidates '''
+        report = {name: {'options': self.best(name)['options'],
+                         'cycles': self.best(name)[name]['cycles']} for name in SCHEDULES}
+        report['ranking'] = 'simulator' if self.memoryPath is not None else 'model'
+        report['candidates'] = [{'options': result['options'], 'error': result['error']} |
+                                {name: result[name]['cycles'] for name in SCHEDULES if result['error'] is None}
+                                for result in self.results]
+        return report
@@ -1,5 +1,5 @@
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from collections import namedtuple
 
 from type import RegType, Reg, Instruction
@@ -15,6 +15,29 @@ class Dep(namedtuple('Dep', ['consumer_reg', 'producer_id', 'producer_id_interlo
     def reg(self):
         return self.consumer_reg
 
+class MemDep(namedtuple('MemDep', ['producer_id', 'distance'])):
+    ''' the `ld`/`st` at `producer_id` accesses the same address `distance`
+    iterations earlier; 0 means within the same iteration (or basic block) '''
+    def __str__(self):
+        if self.distance == 0:
+            return f"mem <- {self.producer_id}"
+        else:
+            return f"mem <- {self.producer_id} @{self.distance}"
+
+class Edge(namedtuple('Edge', ['producer_id', 'consumer_id', 'kind', 'reg', 'latency', 'distance'])):
+    ''' an edge of the dependency graph
+
+    `kind` is the name of the dependency column the edge comes from, `reg` the
+    consumed register (None for memory dependencies), `latency` the latency of
+    the producer, and `distance` the number of iterations between producer and
+    consumer. An inter-loop dependency gives two edges: one from the BB0
+    producer with distance 0 and one from the BB1 producer with distance 1.
+    '''
+    pass
+
+DEP_KINDS  = ['localDeps', 'interLoopDeps', 'loopInvariantDeps', 'postLoopDeps']
+EDGE_KINDS = DEP_KINDS + ['memDeps']
+
 @dataclass
 class DependencyTableEntry:
     #pc: int
@@ -28,6 +51,7 @@ class DependencyTableEntry:
     postLoopDeps     : list[Dep]
     stage            : int = None # used only in pipeline scheduling
     renamedDest      : Reg = None
+    memDeps          : list[MemDep] = field(default_factory=list)
 
 
 class DependencyTable:
@@ -35,6 +59,8 @@ class DependencyTable:
     bb1  : slice
     bb2  : slice
     table: list[DependencyTableEntry]
+    producers: list[dict[str, list[Edge]]] # incoming edges of each instruction, by kind
+    consumers: list[dict[str, list[Edge]]] # outgoing edges of each instruction, by kind
     
     def __init__(self, insts: list[Instruction]):
         self.bb0 = slice(0, len(insts))
@@ -44,6 +70,8 @@ class DependencyTable:
 
         self.delineate(insts)
         self.analyze(insts)
+        self.analyzeMemory(insts)
+        self.index(insts)
 
     def delineate(self, insts) -> None:
         ''' find basic blocks '''
@@ -86,7 +114,7 @@ class DependencyTable:
         for i in range(10**10)[self.bb0]:
             inst = insts[i]
             entry = self.table[i]
-            for rs in set(filter(None, [inst.rs1, inst.rs2])):
+            for rs in dict.fromkeys(filter(None, [inst.rs1, inst.rs2])):
                 # search ahead of the current instruction for local dependency
                 if (p := findDependencies(rs, slice(0, i))) is not None:
                     entry.localDeps.append(Dep(rs, p, None))
@@ -97,7 +125,7 @@ class DependencyTable:
         for i in range(10**10)[self.bb1]:
             inst = insts[i]
             entry = self.table[i]
-            for rs in set(filter(None, [inst.rs1, inst.rs2])):
+            for rs in dict.fromkeys(filter(None, [inst.rs1, inst.rs2])):
                 if (pbb1Before := findDependencies(rs, slice(bb1Start, i))) is not None:
                     # if there exists a producer ahead of current instruction in bb1, it is a local dependency
                     entry.localDeps.append(Dep(rs, pbb1Before, None))
@@ -112,7 +140,7 @@ class DependencyTable:
         for i in range(10**10)[self.bb2]:
             inst = insts[i]
             entry = self.table[i]
-            for rs in set(filter(None, [inst.rs1, inst.rs2])):
+            for rs in dict.fromkeys(filter(None, [inst.rs1, inst.rs2])):
                 if (pbb2 := findDependencies(rs, slice(bb2Start, i))) is not None:
                     # if there exists a producer ahead of current instruction in bb2, it is a local dependency
                     entry.localDeps.append(Dep(rs, pbb2, None))
@@ -124,10 +152,149 @@ class DependencyTable:
                     entry.loopInvariantDeps.append(Dep(rs, pbb0, None))
 
 
+    def addresses(self, insts, block: slice) -> tuple[dict, dict]:
+        ''' symbolic addresses of the memory accesses in a basic block
+
+        Every value is tracked as (root, offset), where root is either the
+        value of a register at the beginning of the block, a constant, or the
+        result of an instruction that is not an `addi`/`mov`. Returns the
+        address of each `ld`/`st` and the value of every register at the end
+        of the block.
+        '''
+        CONST = ('const',)
+        values: dict[Reg, tuple] = {}
+        value = lambda reg: values.get(reg, (('in', reg), 0))
+        addrs: dict[int, tuple] = {}
+        for i in range(10**10)[block]:
+            inst = insts[i]
+            if inst.opcode == 'ld':
+                root, offset = value(inst.rs1)
+                addrs[i] = (root, offset + inst.imm)
+            elif inst.opcode == 'st':
+                root, offset = value(inst.rs2)
+                addrs[i] = (root, offset + inst.imm)
+
+            if inst.rd is None or inst.rd.type != RegType.GENERAL:
+                continue
+            if inst.opcode == 'addi':
+                root, offset = value(inst.rs1)
+                values[inst.rd] = (root, offset + inst.imm)
+            elif inst.opcode == 'mov':
+                values[inst.rd] = value(inst.rs1) if inst.rs1 is not None else (CONST, inst.imm)
+            else:
+                values[inst.rd] = (('inst', i), 0)
+        return addrs, values
+
+    def classifyMemory(self, a: int, b: int, addrs: dict, strides: dict = None) -> int:
+        ''' smallest number of iterations `d` such that `a` and then `b`, `d`
+        iterations later, may access the same address; None if they never do
+
+        `strides` maps an address root to how much it grows per iteration, and
+        is None outside of the loop body.
+        '''
+        (rootA, offsetA), (rootB, offsetB) = addrs[a], addrs[b]
+        minDistance = 0 if a < b else 1
+        if strides is None:
+            if minDistance != 0:
+                return None
+            if rootA != rootB:
+                return 0 # unrelated bases may alias
+            return 0 if offsetA == offsetB else None
+
+        if rootA != rootB or strides.get(rootA) is None:
+            # unrelated bases, or a base that changes unpredictably between
+            # iterations: with the same base, different offsets are only known
+            # not to conflict within an iteration
+            if rootA == rootB and a < b and offsetA != offsetB:
+                return 1
+            return minDistance
+        stride = strides[rootA]
+        if stride == 0:
+            return minDistance if offsetA == offsetB else None
+        # a in iteration k, b in iteration k + d: offsetA = offsetB + d * stride
+        d, rest = divmod(offsetA - offsetB, stride)
+        if rest != 0 or d < minDistance:
+            return None
+        return d
+
+    def analyzeMemory(self, insts) -> None:
+        ''' analyze dependencies between memory accesses
+
+        A `ld`/`st` depends on every earlier access to the same address of
+        which at least one is a `st`. In bb1 the distance of loop-carried
+        dependencies is derived from the stride of the base register, i.e. how
+        much `addi` increments it per iteration.
+        '''
+        for block, loop in [(self.bb0, False), (self.bb1, True), (self.bb2, False)]:
+            addrs, values = self.addresses(insts, block)
+            strides = None
+            if loop:
+                strides = {('const',): 0}
+                for (root, offset) in addrs.values():
+                    if root[0] == 'in':
+                        endRoot, endOffset = values.get(root[1], (root, 0))
+                        strides[root] = endOffset if endRoot == root else None
+            for b in addrs:
+                for a in addrs:
+                    if insts[a].opcode == 'ld' and insts[b].opcode == 'ld':
+                        continue
+                    if a == b and (not loop or insts[a].opcode != 'st'):
+                        continue
+                    if (d := self.classifyMemory(a, b, addrs, strides)) is not None:
+                        self.table[b].memDeps.append(MemDep(a, d))
+
+    def index(self, insts) -> None:
+        ''' build the forward and backward adjacency lists of the dependency graph '''
+        latency = lambda i: 3 if insts[i].opcode == 'mulu' else 1
+        self.producers = [{kind: [] for kind in EDGE_KINDS} for _ in self.table]
+        self.consumers = [{kind: [] for kind in EDGE_KINDS} for _ in self.table]
+
+        def addEdge(edge: Edge) -> None:
+            self.producers[edge.consumer_id][edge.kind].append(edge)
+            self.consumers[edge.producer_id][edge.kind].append(edge)
+
+        for c, entry in enumerate(self.table):
+            for kind in DEP_KINDS:
+                for dep in getattr(entry, kind):
+                    if dep.producer_id is not None:
+                        addEdge(Edge(dep.producer_id, c, kind, dep.consumer_reg, latency(dep.producer_id), 0))
+                    if dep.producer_id_interloop is not None:
+                        addEdge(Edge(dep.producer_id_interloop, c, kind, dep.consumer_reg, latency(dep.producer_id_interloop), 1))
+            for dep in entry.memDeps:
+                addEdge(Edge(dep.producer_id, c, 'memDeps', None, 1, dep.distance))
+
+    def inEdges(self, i: int, kinds: list[str] = DEP_KINDS, distance: int = None):
+        ''' incoming edges of an instruction, optionally of a given distance only '''
+        return (edge for kind in kinds for edge in self.producers[i][kind]
+                     if distance is None or edge.distance == distance)
+
+    def producerOf(self, i: int, reg: Reg) -> int:
+        ''' the instruction whose value instruction `i` reads from `reg`
+
+        A producer before the loop is preferred over the loop-carried one of an
+        inter-loop dependency. None if the register is not produced by the
+        program.
+        '''
+        edge = next((edge for edge in self.inEdges(i) if edge.reg == reg and edge.distance == 0), None) \
+            or next((edge for edge in self.inEdges(i) if edge.reg == reg), None)
+        return edge.producer_id if edge is not None else None
+
+    def heights(self, block: slice) -> dict[int, int]:
+        ''' length in cycles of the longest chain of same-iteration dependencies
+        from each instruction of a basic block to the end of that block '''
+        heights: dict[int, int] = {}
+        for i in reversed(range(10**10)[block]):
+            own = 3 if self.table[i].opcode == 'mulu' else 1
+            heights[i] = max((own + heights[edge.consumer_id]
+                              for kind in EDGE_KINDS for edge in self.consumers[i][kind]
+                              if edge.distance == 0 and edge.consumer_id in heights),
+                             default=own)
+        return heights
+
     def to_csv(self, filename: str) -> None:
         ''' output dependency table to a csv file '''
         with open(filename, 'w', newline='') as csvfile:
-            fieldnames = ['id', 'opcode', 'dest', 'localDeps', 'interLoopDeps', 'loopInvariantDeps', 'postLoopDeps','stage']
+            fieldnames = ['id', 'opcode', 'dest', 'localDeps', 'interLoopDeps', 'loopInvariantDeps', 'postLoopDeps', 'memDeps', 'stage']
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
 
             writer.writeheader()
@@ -140,5 +307,6 @@ class DependencyTable:
                     'interLoopDeps': [str(dep) for dep in entry.interLoopDeps],
                     'loopInvariantDeps': [str(dep) for dep in entry.loopInvariantDeps],
                     'postLoopDeps': [str(dep) for dep in entry.postLoopDeps],
+                    'memDeps': [str(dep) for dep in entry.memDeps],
                     'stage' : entry.stage,
                 })
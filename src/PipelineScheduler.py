@@ -1,11 +1,16 @@
-from dataclasses import dataclass, astuple
-from math        import ceil
-from copy        import deepcopy
-from csv         import DictWriter
+from dataclasses        import dataclass, astuple
+from math               import ceil
+from functools          import partial
+from typing             import Callable
+from copy               import deepcopy
+from csv                import DictWriter
+from collections        import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 import json
 
-from DependencyTable import Dep
-from type import RegType, Reg, RotReg, Instruction, InstClass, _Instruction, Bundle, AutoExtendList
+from DependencyTable import Dep, DEP_KINDS, EDGE_KINDS
+from type import RegType, Reg, RotReg, Instruction, InstClass, _Instruction, Bundle, Schedule, FreeSlots
+from Validator import validate
 
 
 class PipelineScheduler:
@@ -32,13 +37,54 @@ class PipelineScheduler:
                 return self.table[i][instCls] >= 2
             else:
                 return self.table[i][instCls] >= 1
+
+    class State:
+        ''' what scheduling BB1 changes: the bundles, `finishedCycle` and the
+        reservation table
+
+        Every change goes through this class and is journaled, so that
+        `snapshot` is O(1) and `restore` undoes the changes since a snapshot
+        in O(changed entries).
+        '''
+        def __init__(self, schedule: Schedule, finishedCycle: list[int]) -> None:
+            self.schedule = schedule
+            self.finishedCycle = finishedCycle
+            self.reservedTbl: PipelineScheduler.ReservedTable = None
+            self.journal: list[Callable[[], None]] = [] # undo actions, oldest first
+
+        def snapshot(self) -> tuple:
+            return self.schedule.checkpoint(), len(self.journal), self.reservedTbl
+
+        def restore(self, snapshot: tuple) -> None:
+            checkpoint, journalLength, self.reservedTbl = snapshot
+            while len(self.journal) > journalLength:
+                self.journal.pop()()
+            self.schedule.rollback(checkpoint)
+
+        def setFinished(self, i: int, cycle: int) -> None:
+            self.journal.append(partial(self.finishedCycle.__setitem__, i, self.finishedCycle[i]))
+            self.finishedCycle[i] = cycle
+
+        def reserve(self, cycle: int, instCls: InstClass) -> None:
+            row = self.reservedTbl.table[(cycle - self.reservedTbl.bb0_finished_cycle) % self.reservedTbl.ii]
+            self.journal.append(partial(row.__setitem__, instCls, row[instCls]))
+            self.reservedTbl.markReserved(cycle, instCls)
+
+        def insert(self, cycle: int, inst: _Instruction, instCls: InstClass) -> None:
+            bundle = self.schedule.at(cycle)
+            bundle.insert(inst, instCls)
+            self.journal.append(partial(bundle.pop, instCls))
     
     def __init__(self, parent) -> None:
         self.p = parent
-        self.schedule: AutoExtendList[Bundle] = AutoExtendList()
+        self.schedule: Schedule = Schedule()
         self.finalSchedule: list[Bundle] = []
         self.added = 0
         self.ii = self.ii()
+        self.resMII = self.ii
+        self.ii = max(self.ii, self.p.options.iiStart)
+        self.numStage = 0
+        self.bundleCount = {'bb0': 0, 'bb1': 0, 'bb2': 0}
         #self.bb0_finished_cycle = 0
         #self.bb1_finished_cycle = 0
         #self.bb2_finished_cycle = 0
@@ -58,18 +104,66 @@ class PipelineScheduler:
         return tmp
     
     def ii(self):
-        instCount = {clss: 0 for clss in InstClass}
-        exUnitCount = {InstClass.ALU: 2, InstClass.Mulu: 1, InstClass.Mem: 1, InstClass.Branch: 1}
-        for inst in self.p.iCache[self.p.depTable.bb1]:
-            instCount[inst.class_] += 1
-        return max( ceil(instCount[clss] / exUnitCount[clss]) for clss in InstClass)
-        
+        return self.p.resMII()
+
+    def recMII(self) -> int:
+        ''' compute the recurrence bound of II
+
+        For every inter-loop dependency, the longest chain of local
+        dependencies leading from the consumer to the producer in BB1 plus the
+        latency of the producer has to fit within II (Eq. 2).
+        '''
+        iCache = self.p.iCache
+        depTable = self.p.depTable.table
+        bb1 = self.p.depTable.bb1
+        latency = lambda i: 3 if iCache[i].opcode == 'mulu' else 1
+        bound = 0
+        for c in range(bb1.start, bb1.stop):
+            for dep in depTable[c].interLoopDeps:
+                # longest path (in cycles) from the start of `c` to the end of each instruction
+                dist: dict[int, int] = {c: latency(c)}
+                for j in range(c + 1, dep.producer_id_interloop + 1):
+                    pred = [dist[edge.producer_id] for edge in self.p.depTable.inEdges(j, ['localDeps'])
+                                                   if edge.producer_id in dist]
+                    if pred:
+                        dist[j] = max(pred) + latency(j)
+                bound = max(bound, dist.get(dep.producer_id_interloop, 0))
+        return bound
+
+    def report(self, loopCount: int) -> dict:
+        ''' summarize the quality of the pipelined schedule '''
+        kernelFill = {}
+        if self.bundleCount['bb1'] != 0:
+            kernel = self.finalSchedule[self.bundleCount['bb0']:self.bundleCount['bb0'] + self.bundleCount['bb1']]
+            exUnitCount = {InstClass.ALU: 2, InstClass.Mulu: 1, InstClass.Mem: 1, InstClass.Branch: 1}
+            for clss in InstClass:
+                used = sum(bundle.counts[clss] for bundle in kernel)
+                kernelFill[clss.name] = round(used / (exUnitCount[clss] * len(kernel)), 4)
+        return {
+            'bundles': dict(self.bundleCount),
+            'ii': self.ii if self.bundleCount['bb1'] != 0 else None,
+            'resMII': self.resMII,
+            'recMII': self.recMII(),
+            'stages': self.numStage,
+            'kernelFill': kernelFill,
+            'predictedCycles': self.predictCycles(loopCount),
+        }
+
+    def predictCycles(self, loopCount: int) -> int:
+        ''' number of cycles the simulator takes for `LC = loopCount`
+
+        The kernel runs LC + 1 times plus EC = numStage - 1 times to drain the
+        pipeline; the simulator ticks twice more after the last bundle.
+        '''
+        kernelRuns = loopCount + 1 + self.numStage - 1 if self.bundleCount['bb1'] != 0 else 0
+        return self.bundleCount['bb0'] + kernelRuns * self.bundleCount['bb1'] + self.bundleCount['bb2'] + 2
     
     def _schedule(self):
         ''' schedule bb0 using old scheme '''
         iCache = self.p.iCache
         finished_cycle = [None] * len(iCache) # record the cycle when each instruction is finished (i.e. visible)
         depTable = self.p.depTable.table
+        depGraph = self.p.depTable
         bb1 = self.p.depTable.bb1
         bb0_finished_cycle = 0
         bb1_finished_cycle = 0
@@ -79,88 +173,50 @@ class PipelineScheduler:
         def schedule_single_bb(range: slice, prev_bb_finished_cycle: int):
             ''' schedule a single basic block '''
             curr_bb_finished_cycle = prev_bb_finished_cycle
-            for i, inst in list(enumerate(iCache))[range]:
-                deps = depTable[i].localDeps + depTable[i].interLoopDeps + depTable[i].loopInvariantDeps + depTable[i].postLoopDeps
-                earliest_cycle = max((finished_cycle[dep.producer_id] for dep in deps if dep.producer_id is not None),
+            freeSlots = FreeSlots(self.schedule)
+            order = list(enumerate(iCache))[range]
+            if self.p.options.priority == 'height':
+                # longest path to the end of the block first; this is still a
+                # topological order since a producer is higher than its consumers
+                heights = depGraph.heights(range)
+                order.sort(key = lambda t: -heights[t[0]])
+            for i, inst in order:
+                kinds = EDGE_KINDS if self.p.options.memDeps else DEP_KINDS
+                earliest_cycle = max((finished_cycle[edge.producer_id] for edge in depGraph.inEdges(i, kinds, distance = 0)),
                                      default=prev_bb_finished_cycle)
                 if earliest_cycle < prev_bb_finished_cycle:
                     earliest_cycle = prev_bb_finished_cycle
                 _inst = _Instruction.from_instruction(inst,i)
-                while not self.schedule[earliest_cycle].insert(_inst, inst.class_):
-                    earliest_cycle += 1
+                earliest_cycle = freeSlots.insert(_inst, inst.class_, earliest_cycle)
                 inst_finished_cycle = earliest_cycle + 1 if inst.opcode != 'mulu' else earliest_cycle + 3
                 finished_cycle[i] = inst_finished_cycle
                 if (inst_finished_cycle > curr_bb_finished_cycle):
                     curr_bb_finished_cycle = inst_finished_cycle
             return curr_bb_finished_cycle        
 
-        def schedule_bb1() -> bool:
-            ''' schedule bb1
-
-            There are 2 cases where one has to increment `self.ii` and re-
-            schedule BB1:
-            1. the schedule does not satisfy Eq. 2, or
-            2. instructions across iterations occupy the same `ReservedTable`
-               slot
-            '''
-            nonlocal bb1_finished_cycle
-
-            localBb1FinishedCycle = bb0_finished_cycle
-            reservedTbl = self.ReservedTable(self.ii,
-                                             bb0_finished_cycle)    
-            for i, inst in list(enumerate(iCache))[slice(bb1.start, bb1.stop - 1)]:
-                deps = depTable[i].localDeps     \
-                     + depTable[i].interLoopDeps \
-                     + depTable[i].loopInvariantDeps
-                #print('finished_cycle:', finished_cycle)
-                earliest_cycle = max((finished_cycle[dep.producer_id] for dep in deps
-                                                                          if dep.producer_id is not None),
-                                     default=bb0_finished_cycle)
-                if earliest_cycle < bb0_finished_cycle:
-                    earliest_cycle = bb0_finished_cycle
-                
-                failedSchedule = 0
-                while reservedTbl.isReserved(cycle = earliest_cycle,
-                                             instCls = inst.class_):
-                    earliest_cycle += 1
-                    failedSchedule += 1
-                    if failedSchedule == self.ii:
-                        return False
-                
-                instFinishedCycle = earliest_cycle + 3 if inst.opcode == 'mulu' else earliest_cycle + 1
-                finished_cycle[i] = instFinishedCycle
-                localBb1FinishedCycle = max(localBb1FinishedCycle, instFinishedCycle)
-                # check Eq. 2
-                for j in range(self.p.depTable.bb0.stop, i+1): # possibly self-dependent
-                    for dep in depTable[j].interLoopDeps:
-                        if dep.producer_id_interloop == i:
-                            SC = finished_cycle[j] - 3 if iCache[j].opcode == 'mulu' else finished_cycle[j] - 1
-                            #  S(P) + λ(P)       > II      + S(C)
-                            if instFinishedCycle > self.ii + SC:
-                                return False                    
-                reservedTbl.markReserved(earliest_cycle, inst.class_)
-                _inst = _Instruction.from_instruction(inst, i)
-                self.schedule[earliest_cycle].insert(_inst, inst.class_)
-            bb1_finished_cycle = localBb1FinishedCycle
-            return True
-
         bb0_finished_cycle = schedule_single_bb(self.p.depTable.bb0, 0)
+        self.schedule.grow(bb0_finished_cycle)
         if (bb1.stop - bb1.start) != 0:
-            while not schedule_bb1():
+            state = self.State(self.schedule, finished_cycle)
+            bb0Snapshot = state.snapshot()
+            while (bb1_finished_cycle := self.schedule_bb1(state, bb0_finished_cycle)) is None:
                 # print(f'II = {self.ii} is not enough, incrementing II')
-                # revert previous changes to self.schedule and finished_cycle
-                self.schedule = self.schedule[ :bb0_finished_cycle]
-                finished_cycle[ :bb0_finished_cycle].extend([None] * (len(iCache) - bb0_finished_cycle))
-
+                # revert the bundles, finished cycles and reservations of the failed attempt
+                state.restore(bb0Snapshot)
                 self.ii += 1
+                if self.p.options.iiJobs > 1:
+                    # retries are likely, search the next IIs in parallel
+                    self.ii = self.searchII(finished_cycle, bb0_finished_cycle)
             # pad `self.schedule` with empty bundle(s) towards a length of multiple
             # of `self.ii`
             while (bb1_finished_cycle - bb0_finished_cycle) % self.ii:
                 bb1_finished_cycle += 1
+            self.schedule.grow(bb1_finished_cycle)
             loop_inst = _Instruction.from_instruction(self.p.iCache[bb1.stop - 1], bb1.stop - 1)
             loop_inst.imm = bb0_finished_cycle
             self.schedule[bb1_finished_cycle - 1].insert(loop_inst, InstClass.Branch) # this is guaranteed to return true
             bb2_finished_cycle = schedule_single_bb(self.p.depTable.bb2, bb1_finished_cycle)
+            self.schedule.grow(bb2_finished_cycle)
             numStage = (bb1_finished_cycle - bb0_finished_cycle) // self.ii
         
         class FreshRegGenerator:
@@ -180,8 +236,6 @@ class PipelineScheduler:
                 tmp = self.base
                 self.base += (self.numStage + 1)
                 return RotReg(RegType.GENERAL, tmp)
-        # maintain scheduling order
-        self.sort()
         ''' step 2.0 mask independent rs in BB1 '''
         nullReg = RotReg(RegType.GENERAL, -1)
         for bundle in self.schedule:
@@ -205,13 +259,58 @@ class PipelineScheduler:
                    inst.rs2 not in deps:
                     inst.rs2 = nullReg     
         ''' step 2.1 rename rd in BB1'''
-        freshRot = FreshRotGenerator(numStage)
-        # Attention: only rename rd in BB1 now
         for idx, bundle in enumerate(self.schedule[bb0_finished_cycle:bb1_finished_cycle]):
             for inst in bundle.insts:
                 depTable[inst.id].stage = idx // self.ii # `idx` is not PC!
+
+        def lifetime(i: int, idx: int) -> tuple[int, int]:
+            ''' registers needed below and from the base of the value of `i`
+
+            The value produced at stage s is read `s' - s` stages later by a
+            local consumer at stage s', one stage later still by an interloop
+            one and at the last stage by BB2. A `mulu` lands in its register
+            when the pipeline may have rotated already. The instance written
+            in BB0 for an interloop dependency sits `s - 1` below the base.
+            '''
+            stage = depTable[i].stage
+            latency = 3 if iCache[i].opcode == 'mulu' else 1
+            last = stage + (idx % self.ii + latency - 1) // self.ii
+            below = 0
+            for edge in depGraph.consumers[i]['localDeps']:
+                last = max(last, depTable[edge.consumer_id].stage)
+            for edge in depGraph.consumers[i]['interLoopDeps']:
+                last = max(last, depTable[edge.consumer_id].stage + 1)
+                if bb1bb0ProducerMap.get(i) is not None:
+                    below = max(below, stage - 1)
+            if depGraph.consumers[i]['postLoopDeps']:
+                last = max(last, numStage - 1)
+            return below, last - stage + 1
+
+        class LifetimeRotAllocator:
+            ''' pack the registers of each value by its lifetime '''
+            base: int = 32
+
+            def __call__(self, below: int, span: int) -> Reg:
+                tmp = self.base + below
+                self.base += below + span
+                if self.base > 96:
+                    raise ValueError('Out of rotating registers')
+                return RotReg(RegType.GENERAL, tmp)
+
+        # the BB0 producer (if any) of each interloop dependency
+        bb1bb0ProducerMap: dict[int, int] = {} # key: `producer_id_interloop`; value: `producer_id``
+        for bundle in self.schedule[bb0_finished_cycle:bb1_finished_cycle]:
+            for inst in bundle.insts:
+                for dep in depTable[inst.id].interLoopDeps:
+                    bb1bb0ProducerMap[dep.producer_id_interloop] = dep.producer_id
+
+        compact = self.p.options.compactRotRegs
+        freshRot = LifetimeRotAllocator() if compact else FreshRotGenerator(numStage)
+        # Attention: only rename rd in BB1 now
+        for idx, bundle in enumerate(self.schedule[bb0_finished_cycle:bb1_finished_cycle]):
+            for inst in bundle.insts:
                 if (inst.rd is not None) and inst.rd.type == RegType.GENERAL:
-                    tmp = freshRot()
+                    tmp = freshRot(*lifetime(inst.id, idx)) if compact else freshRot()
 
                     inst.rd = tmp
                     depTable[inst.id].renamedDest = tmp
@@ -238,40 +337,37 @@ class PipelineScheduler:
         for bundle in self.schedule[ bb0_finished_cycle:bb1_finished_cycle ]:
             for inst in bundle.insts:
                 for dep in depTable[inst.id].loopInvariantDeps:
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs1 == dep.consumer_reg:
                         inst.rs1 = depTable[dep.producer_id].renamedDest
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         inst.rs2 = depTable[dep.producer_id].renamedDest
         # local dependency: increment stage offset
         for bundle in self.schedule[bb0_finished_cycle:bb1_finished_cycle]:
             for inst in bundle.insts:
                 for dep in depTable[inst.id].localDeps:
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs1 == dep.consumer_reg:
                         tmp: Reg = deepcopy(depTable[dep.producer_id].renamedDest)
                         tmp.stageOffset += depTable[inst.id].stage \
                                         -  depTable[dep.producer_id].stage
                         inst.rs1 = tmp
                     
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         tmp: Reg = deepcopy(depTable[dep.producer_id].renamedDest)
                         tmp.stageOffset += depTable[inst.id].stage \
                                         -  depTable[dep.producer_id].stage
                         inst.rs2 = tmp
         # interloop dependency: increment stage offset
-        bb1bb0ProducerMap: dict[int, int] = {} # key: `producer_id_interloop`; value: `producer_id``
         for idx, bundle in enumerate(self.schedule[bb0_finished_cycle:bb1_finished_cycle]):
             for inst in bundle.insts:
                 for dep in depTable[inst.id].interLoopDeps:
-                    bb1bb0ProducerMap[dep.producer_id_interloop] = dep.producer_id
-                    
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:                          
+                    if iCache[inst.id].rs1 == dep.consumer_reg:                          
                         tmp: Reg = deepcopy(depTable[dep.producer_id_interloop].renamedDest)
                         tmp.stageOffset += depTable[inst.id].stage \
                                          - depTable[dep.producer_id_interloop].stage
                         tmp.iterOffset += 1
                         inst.rs1 = tmp
                     
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         tmp: Reg = deepcopy(depTable[dep.producer_id_interloop].renamedDest)
                         tmp.stageOffset += depTable[inst.id].stage \
                                         -  depTable[dep.producer_id_interloop].stage
@@ -309,23 +405,23 @@ class PipelineScheduler:
             bundle = self.schedule[idx]
             for inst in bundle.insts:
                 for dep in depTable[inst.id].localDeps:
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs1 == dep.consumer_reg:
                         tmp = depTable[dep.producer_id].renamedDest
                         inst.rs1 = tmp
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         tmp = depTable[dep.producer_id].renamedDest
                         inst.rs2 = tmp
         # 2.4.3 post dependency
         for bundle in self.schedule[bb1_finished_cycle:bb2_finished_cycle]:
             for inst in bundle.insts:
                 for dep in depTable[inst.id].postLoopDeps:
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs1 == dep.consumer_reg:
                         tmp = deepcopy(depTable[dep.producer_id].renamedDest)
                         tmp.iterOffset  = 0
                         tmp.stageOffset = numStage - 1 - depTable[dep.producer_id].stage
                         inst.rs1 = tmp
                     
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         tmp = deepcopy(depTable[dep.producer_id].renamedDest)
                         tmp.iterOffset  = 0
                         tmp.stageOffset = numStage - 1 - depTable[dep.producer_id].stage
@@ -334,10 +430,10 @@ class PipelineScheduler:
         for bundle in (self.schedule[bb1_finished_cycle:bb2_finished_cycle]): # There shall be no loop-invariant dependency in BB0.
             for inst in bundle.insts:
                 for dep in depTable[inst.id].loopInvariantDeps:
-                    if (inst.rs1 is not None) and inst.rs1.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs1 == dep.consumer_reg:
                         inst.rs1 = depTable[dep.producer_id].renamedDest
                     
-                    if (inst.rs2 is not None) and inst.rs2.idx == dep.consumer_reg.idx:
+                    if iCache[inst.id].rs2 == dep.consumer_reg:
                         inst.rs2 = depTable[dep.producer_id].renamedDest
         # 2.4.5 unused register
         for bundle in self.schedule:
@@ -349,7 +445,7 @@ class PipelineScheduler:
                     inst.rs2 = freshReg()
         ''' step 3 prepare loop predicate '''
         ''' self.schedule & bb_finished_cycle are read only from here on'''
-        bb0Schedule = deepcopy(self.schedule[ :bb0_finished_cycle])
+        bb0Schedule = deepcopy(list(self.schedule[ :bb0_finished_cycle]))
         if bb1.stop - bb1.start == 0:
             while (len(bb0Schedule) > 0 and len(bb0Schedule[-1].insts) ==0 ):
                 bb0Schedule.pop()
@@ -357,7 +453,7 @@ class PipelineScheduler:
         movInst1 = _Instruction(opcode = 'mov', id = -1, rd = Reg(RegType.PREDICATE, 32), imm = 1)
         movInst2 = _Instruction(opcode = 'mov', id = -1, rd = Reg(RegType.EC, None), imm = numStage - 1)
         
-        if bb1.stop - bb1.start != 0:
+        if bb1.stop - bb1.start != 0 and not self.p.options.compactPip:
             while bb0Schedule[-1].insert(movInst2, InstClass.ALU) == False:
                 bb0Schedule.append(Bundle())
                 self.added += 1
@@ -371,23 +467,168 @@ class PipelineScheduler:
         for idx in range(self.ii):
             bundle = Bundle()
             for stage in range(numStage):
-                bundle.insts.extend(self.schedule[bb0_finished_cycle + stage * self.ii + idx].insts)
-                bundle.template.extend(self.schedule[bb0_finished_cycle + stage * self.ii + idx].template)
+                stageBundle = self.schedule[bb0_finished_cycle + stage * self.ii + idx]
+                for inst, clss in zip(stageBundle.insts, stageBundle.template):
+                    bundle.insert(inst, clss) # the reservation table guarantees a free slot
             bb1Schedule.append(bundle)
 
-        bb2Schedule = deepcopy(self.schedule[bb1_finished_cycle:bb2_finished_cycle])
+        bb2Schedule = deepcopy(list(self.schedule[bb1_finished_cycle:bb2_finished_cycle]))
         while len(bb2Schedule) > 0 and len(bb2Schedule[-1].insts) == 0:
             bb2Schedule.pop()
+        if bb1.stop - bb1.start != 0 and self.p.options.compactPip:
+            bb2Schedule = self.compact(bb0Schedule, bb2Schedule, finished_cycle, [movInst2, movInst1])
         
         self.finalSchedule = bb0Schedule
+        self.numStage = numStage
+        self.bundleCount['bb0'] = len(bb0Schedule)
         if bb1.stop - bb1.start != 0:
             self.finalSchedule = self.finalSchedule \
                                + bb1Schedule        \
                                + bb2Schedule
+            self.bundleCount['bb1'] = len(bb1Schedule)
+            self.bundleCount['bb2'] = len(bb2Schedule)
 
-    def sort(self) -> None:
-        for bundle in self.schedule:
-            bundle.sort()
+    def schedule_bb1(self, state: State, bb0_finished_cycle: int) -> int:
+        ''' schedule bb1
+
+        There are 2 cases where one has to increment `self.ii` and re-
+        schedule BB1:
+        1. the schedule does not satisfy Eq. 2, or
+        2. instructions across iterations occupy the same `ReservedTable`
+           slot
+
+        Instructions are placed in the order of `options.priority`, as in
+        BB0 and BB2; an instruction is scheduled already iff it has a
+        finished cycle. Returns the cycle BB1 finishes at with `self.ii`,
+        None if it cannot be scheduled. Only reads `self`; everything it
+        changes is in `state`.
+        '''
+        iCache = self.p.iCache
+        depGraph = self.p.depTable
+        bb1 = depGraph.bb1
+        finished_cycle = state.finishedCycle
+        loopCarried = ['interLoopDeps', 'memDeps'] if self.p.options.memDeps else ['interLoopDeps']
+
+        localBb1FinishedCycle = bb0_finished_cycle
+        state.reservedTbl = self.ReservedTable(self.ii,
+                                               bb0_finished_cycle)
+        order = list(enumerate(iCache))[slice(bb1.start, bb1.stop - 1)]
+        if self.p.options.priority == 'height':
+            heights = depGraph.heights(slice(bb1.start, bb1.stop - 1))
+            order.sort(key = lambda t: -heights[t[0]])
+        for i, inst in order:
+            #print('finished_cycle:', finished_cycle)
+            earliest_cycle = max((finished_cycle[edge.producer_id] for edge in depGraph.inEdges(i, distance = 0)),
+                                 default=bb0_finished_cycle)
+            # S(P) + λ(P) - d * II <= S(C) for producers already scheduled
+            earliest_cycle = max([earliest_cycle] + [finished_cycle[edge.producer_id] - edge.distance * self.ii
+                                                     for edge in depGraph.inEdges(i, loopCarried)
+                                                     if finished_cycle[edge.producer_id] is not None])
+            if earliest_cycle < bb0_finished_cycle:
+                earliest_cycle = bb0_finished_cycle
+            
+            failedSchedule = 0
+            while state.reservedTbl.isReserved(cycle = earliest_cycle,
+                                               instCls = inst.class_):
+                earliest_cycle += 1
+                failedSchedule += 1
+                if failedSchedule == self.ii:
+                    return None
+            
+            instFinishedCycle = earliest_cycle + 3 if inst.opcode == 'mulu' else earliest_cycle + 1
+            state.setFinished(i, instFinishedCycle)
+            localBb1FinishedCycle = max(localBb1FinishedCycle, instFinishedCycle)
+            # check Eq. 2 for consumers scheduled already (possibly self-dependent)
+            for kind in loopCarried:
+                for edge in depGraph.consumers[i][kind]:
+                    j = edge.consumer_id
+                    if edge.distance == 0 or finished_cycle[j] is None:
+                        continue
+                    SC = finished_cycle[j] - 3 if iCache[j].opcode == 'mulu' else finished_cycle[j] - 1
+                    #  S(P) + λ(P)       > d * II               + S(C)
+                    if instFinishedCycle > edge.distance * self.ii + SC:
+                        return None
+            state.reserve(earliest_cycle, inst.class_)
+            state.insert(earliest_cycle, _Instruction.from_instruction(inst, i), inst.class_)
+        return localBb1FinishedCycle
+
+    def searchII(self, finishedCycle: list[int], bb0_finished_cycle: int) -> int:
+        ''' smallest II from `self.ii` on for which BB1 can be scheduled
+
+        `iiJobs` candidates are scheduled at a time, each by a worker process
+        on its own copy of the state after BB0. The window slides as the
+        smallest candidates fail; once one succeeds, the larger ones still
+        queued are cancelled.
+        '''
+        executor = ProcessPoolExecutor(max_workers=self.p.options.iiJobs)
+        pending: deque[tuple[int, Future]] = deque()
+        candidate = self.ii
+        try:
+            while True:
+                while len(pending) < self.p.options.iiJobs:
+                    pending.append((candidate, executor.submit(tryII, self, finishedCycle, bb0_finished_cycle, candidate)))
+                    candidate += 1
+                ii, future = pending.popleft()
+                if future.result():
+                    return ii
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def compact(self, bb0Schedule: list[Bundle], bb2Schedule: list[Bundle],
+                      finishedCycle: list[int], setup: list[_Instruction]) -> list[Bundle]:
+        ''' overlap the loop setup and BB2 with the slack of BB0
+
+        `setup` (`mov EC`, `mov p32`) goes in free ALU slots of BB0, rather
+        than in new bundles. ALU and `mulu` instructions of BB2 that depend
+        on nothing produced by the loop are hoisted into BB0 wherever their
+        producers have finished; they write fresh static registers, so this
+        is safe. BB2 is then re-packed ASAP. `bb0Schedule` is modified in
+        place and the new BB2 is returned.
+        '''
+        iCache = self.p.iCache
+        depTable = self.p.depTable.table
+        latency = lambda i: 3 if iCache[i].opcode == 'mulu' else 1
+        for inst in setup:
+            free = next((bundle for bundle in bb0Schedule if bundle.canInsert(InstClass.ALU)), None)
+            if free is None:
+                free = Bundle()
+                bb0Schedule.append(free)
+                self.added += 1
+            free.insert(inst, InstClass.ALU)
+
+        bb2Insts = sorted(((inst, clss) for bundle in bb2Schedule for inst, clss in zip(bundle.insts, bundle.template)),
+                          key=lambda t: t[0].id)
+        hoisted: dict[int, int] = {} # key: instruction id; value: finished cycle in BB0
+        for inst, clss in bb2Insts:
+            entry = depTable[inst.id]
+            if clss not in (InstClass.ALU, InstClass.Mulu)                                  or \
+               inst.rd is None or inst.rd.type != RegType.GENERAL                             or \
+               any(isinstance(reg, RotReg) for reg in (inst.rd, inst.rs1, inst.rs2))         or \
+               entry.postLoopDeps or any(dep.producer_id not in hoisted for dep in entry.localDeps):
+                continue
+            cycle = max([hoisted[dep.producer_id] for dep in entry.localDeps] +
+                        [finishedCycle[dep.producer_id] for dep in entry.loopInvariantDeps] + [0])
+            # the result has to be visible before the loop starts
+            while cycle + latency(inst.id) <= len(bb0Schedule) and not bb0Schedule[cycle].canInsert(clss):
+                cycle += 1
+            if cycle + latency(inst.id) > len(bb0Schedule):
+                continue
+            bb0Schedule[cycle].insert(inst, clss)
+            hoisted[inst.id] = cycle + latency(inst.id)
+
+        # re-pack what is left; values of BB0 and BB1 are visible at the start of BB2
+        schedule = Schedule()
+        freeSlots = FreeSlots(schedule)
+        finished: dict[int, int] = {}
+        kinds = EDGE_KINDS if self.p.options.memDeps else DEP_KINDS
+        for inst, clss in bb2Insts:
+            if inst.id in hoisted:
+                continue
+            cycle = max((finished[edge.producer_id] for edge in self.p.depTable.inEdges(inst.id, kinds, distance = 0)
+                                                    if edge.producer_id in finished), default=0)
+            cycle = freeSlots.insert(inst, clss, cycle)
+            finished[inst.id] = cycle + latency(inst.id)
+        return list(schedule)
 
     # def to_csv(self, output_path: str):
     #     self.sort() # Why
@@ -401,8 +642,6 @@ class PipelineScheduler:
 
 
     def to_csv(self, output_path: str):
-        for bundle in self.finalSchedule:
-            bundle.sort()
         with open(output_path, 'w') as f:
             fieldnames = ['ALU1', 'ALU2', 'Mulu', 'Mem', 'Branch']
             writer = DictWriter(f, fieldnames=fieldnames)
@@ -411,10 +650,19 @@ class PipelineScheduler:
                 lst = bundle.to_list_pip(self.p.depTable.table, self.added)
                 writer.writerow({'ALU1': lst[0], 'ALU2': lst[1], 'Mulu': lst[2], 'Mem': lst[3], 'Branch': lst[4]})
 
+    def to_list(self) -> list[list[str]]:
+        schedule = [bundle.to_list_pip(self.p.depTable.table, self.added) for bundle in self.finalSchedule]
+        return validate(schedule, 'loop.pip schedule') if self.p.options.validate else schedule
+
     def to_json(self, output_path):
-        for bundle in self.finalSchedule:
-            bundle.sort()
-        
         with open(output_path, 'w') as f:
-            json.dump([bundle.to_list_pip(self.p.depTable.table, self.added) for bundle in self.finalSchedule], f,
+            json.dump(self.to_list(), f,
                       indent=4)
+
+
+def tryII(scheduler: PipelineScheduler, finishedCycle: list[int], bb0_finished_cycle: int, ii: int) -> bool:
+    ''' whether BB1 can be scheduled with `ii`; runs in a worker process on
+    copies of the scheduler and of the state after BB0 '''
+    scheduler.ii = ii
+    state = PipelineScheduler.State(scheduler.schedule, finishedCycle)
+    return scheduler.schedule_bb1(state, bb0_finished_cycle) is not None
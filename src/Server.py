@@ -0,0 +1,140 @@
+from collections        import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+from dataclasses        import asdict
+import json
+import socketserver
+import sys
+import threading
+
+from VLIW470 import VLIW470
+
+
+def compileRequest(insts: list[str], options: VLIW470.Options, outputs: tuple[str, ...],
+                   report: bool, loopCount: int) -> dict:
+    ''' compile one request; runs in a worker process '''
+    compiler = VLIW470(insts, options)
+    response = {}
+    if 'simple' in outputs:
+        response['simple'] = compiler.simpleScheduler.to_list()
+    if 'pip' in outputs:
+        response['pip'] = compiler.pipelineScheduler.to_list()
+    if report:
+        response['report'] = compiler.report(loopCount)
+    return response
+
+
+class Server:
+    ''' long-running compiler speaking JSON lines
+
+    Every request is a JSON object on its own line:
+
+        {"id": 1, "insts": [...], "options": {"memDeps": true},
+         "outputs": ["simple", "pip"], "report": false, "loopCount": null}
+
+    Only `insts` is required; `options` are fields of `VLIW470.Options`. The
+    response, on one line as well, echoes `id` and holds the requested
+    schedules (and report), or an `error`. Requests are compiled concurrently
+    by a pool of `jobs` worker processes, so responses may come out of order.
+    The last `cacheSize` responses are kept and served without compiling.
+    '''
+
+    def __init__(self, jobs: int = None, cacheSize: int = 256) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=jobs)
+        self.cacheSize = cacheSize
+        self.cache: OrderedDict[str, dict] = OrderedDict()
+        self.lock = threading.Lock() # guards `cache`
+
+    def submit(self, line: str) -> Future:
+        ''' parse a request line and return the future of its response '''
+        future = Future()
+        id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise TypeError('the request must be a JSON object')
+            id = request.get('id')
+            insts = request['insts']
+            if not isinstance(insts, list) or not all(isinstance(inst, str) for inst in insts):
+                raise TypeError('`insts` must be a list of strings')
+            options = VLIW470.Options(**request.get('options', {}))
+            outputs = request.get('outputs', ['simple', 'pip'])
+            if not isinstance(outputs, list) or not set(outputs) <= {'simple', 'pip'}:
+                raise ValueError("`outputs` must be a list of 'simple' and 'pip'")
+            outputs = tuple(outputs)
+            report = bool(request.get('report', False))
+            loopCount = request.get('loopCount')
+            if loopCount is not None and type(loopCount) is not int:
+                raise TypeError('`loopCount` must be an integer or null')
+            # a string, so that any option value can be part of the key
+            key = json.dumps([insts, asdict(options), outputs, report, loopCount], sort_keys=True)
+        except Exception as e:
+            future.set_result({'id': id, 'error': f'{type(e).__name__}: {e}'})
+            return future
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                future.set_result({'id': id} | self.cache[key])
+                return future
+
+        def done(compiled: Future) -> None:
+            try:
+                response = compiled.result()
+            except Exception as e:
+                future.set_result({'id': id, 'error': f'{type(e).__name__}: {e}'})
+                return
+            with self.lock:
+                self.cache[key] = response
+                if len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+            future.set_result({'id': id} | response)
+
+        try:
+            compiled = self.executor.submit(compileRequest, insts, options, outputs, report, loopCount)
+        except Exception as e: # e.g. BrokenProcessPool once a worker died
+            future.set_result({'id': id, 'error': f'{type(e).__name__}: {e}'})
+            return future
+        compiled.add_done_callback(done)
+        return future
+
+    def serve(self, lines, write) -> None:
+        ''' answer every request of `lines`, writing each response with `write` '''
+        writeLock = threading.Lock()
+        pending = []
+
+        def reply(future: Future) -> None:
+            with writeLock:
+                write(json.dumps(future.result()) + '\n')
+
+        for line in lines:
+            if not line.strip():
+                continue
+            future = self.submit(line)
+            future.add_done_callback(reply)
+            pending.append(future)
+            pending = [future for future in pending if not future.done()]
+        for future in pending:
+            future.result()
+
+    def serveStdio(self) -> None:
+        def write(text: str) -> None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        self.serve(sys.stdin, write)
+
+    def serveSocket(self, path: str) -> None:
+        ''' serve every connection to the unix socket at `path` in its own thread '''
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                def write(text: str) -> None:
+                    self.wfile.write(text.encode())
+                    self.wfile.flush()
+                server.serve((line.decode() for line in self.rfile), write)
+
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unixServer:
+            unixServer.serve_forever()
+
+    def close(self) -> None:
+        self.executor.shutdown()
@@ -1,33 +1,34 @@
-from type import RegType, Reg, Instruction, InstClass, _Instruction, Bundle, AutoExtendList
-from itertools import islice
+from type import RegType, Reg, Instruction, InstClass, _Instruction, Bundle, Schedule, FreeSlots
+from DependencyTable import DEP_KINDS, EDGE_KINDS
+from Validator import validate
+import heapq
 import json
 import csv
 
 
 class SimpleScheduler:
 
-    schedule: AutoExtendList[Bundle]
+    schedule: Schedule
 
     def __init__(self, parent):
         self.p = parent
-        self.schedule = AutoExtendList()
+        self.schedule = Schedule()
         self.bb0_finished_cycle = 0
         self.bb1_finished_cycle = 0
         self.bb2_finished_cycle = 0
+        self.movCount = 0 # number of `mov` inserted by step 2.3
         self._schedule()
 
 
-    def sort(self):
-        for bundle in self.schedule:
-            bundle.sort()
+    def to_list(self) -> list[list[str]]:
+        schedule = [bundle.to_list() for bundle in self.schedule]
+        return validate(schedule, 'loop schedule') if self.p.options.validate else schedule
 
     def to_json(self, output_path):
-        self.sort()
         with open(output_path, 'w') as f:
-            json.dump([bundle.to_list() for bundle in self.schedule], f,
+            json.dump(self.to_list(), f,
                       indent=4)
     def to_csv(self, output_path):
-        self.sort()
         with open(output_path, 'w') as f:
             fieldnames = ['ALU1', 'ALU2', 'Mulu', 'Mem', 'Branch']
             writer = csv.DictWriter(f, fieldnames=fieldnames)
@@ -36,6 +37,93 @@ class SimpleScheduler:
                 lst = bundle.to_list()
                 writer.writerow({'ALU1': lst[0], 'ALU2': lst[1], 'Mulu': lst[2], 'Mem': lst[3], 'Branch': lst[4]})
 
+    def bundleCount(self) -> dict:
+        ''' number of bundles in each basic block '''
+        bb1 = self.p.depTable.bb1
+        if bb1.stop == bb1.start:
+            return {'bb0': len(self.schedule), 'bb1': 0, 'bb2': 0}
+        return {'bb0': self.bb0_finished_cycle,
+                'bb1': self.bb1_finished_cycle - self.bb0_finished_cycle,
+                'bb2': len(self.schedule) - self.bb1_finished_cycle}
+
+    def report(self, loopCount: int) -> dict:
+        ''' summarize the quality of the schedule '''
+        return {
+            'bundles': self.bundleCount(),
+            'movFixups': self.movCount,
+            'predictedCycles': self.predictCycles(loopCount),
+        }
+
+    def predictCycles(self, loopCount: int) -> int:
+        ''' number of cycles the simulator takes for `LC = loopCount`
+
+        BB1 runs LC + 1 times; the simulator ticks twice more after the last
+        bundle.
+        '''
+        count = self.bundleCount()
+        return count['bb0'] + (loopCount + 1) * count['bb1'] + count['bb2'] + 2
+
+    def allocateRegisters(self):
+        ''' map the renamed registers onto as few registers as possible
+
+        Linear scan over the live ranges in the final bundle order. A value
+        holds its register from the cycle it is written (two cycles after a
+        `mulu` issues) until its last read; reads happen before writes, so
+        another value may be written in the cycle of that read. A value read
+        in the loop before being (re)written is live around the back edge and
+        holds its register for the whole loop. Registers read before being
+        written are live from the start, so they keep their initial value.
+        '''
+        bb1 = self.p.depTable.bb1
+        depTable = self.p.depTable.table
+        loop = range(self.bb0_finished_cycle, self.bb1_finished_cycle) if bb1.stop != bb1.start else range(0)
+        writes: dict[int, list[int]] = {}
+        reads: dict[int, list[int]] = {}
+        for cycle, bundle in enumerate(self.schedule):
+            for inst in bundle.insts:
+                for reg in (inst.rs1, inst.rs2):
+                    if reg is not None and reg.type == RegType.GENERAL:
+                        reads.setdefault(reg.idx, []).append(cycle)
+                if inst.rd is not None and inst.rd.type == RegType.GENERAL:
+                    writes.setdefault(inst.rd.idx, []).append(cycle + 2 if inst.opcode == 'mulu' else cycle)
+
+        intervals = []
+        for idx in writes.keys() | reads.keys():
+            idxWrites, idxReads = writes.get(idx, []), reads.get(idx, [])
+            start = min(idxWrites, default=-1)
+            if idxReads and min(idxReads) <= start:
+                start = -1 # the initial value is read
+            end = max(idxReads + [w + 1 for w in idxWrites])
+            if any(r in loop and not any(w in loop and w < r for w in idxWrites)
+                   for r in idxReads):
+                start, end = min(start, loop.start), max(end, loop.stop)
+            intervals.append((start, end, idx))
+        intervals.sort()
+
+        mapping: dict[int, int] = {}
+        active: list[tuple[int, int]] = [] # heap of (end, register)
+        free: list[int] = [] # heap of released registers
+        count = 0
+        for start, end, idx in intervals:
+            while active and active[0][0] <= start:
+                heapq.heappush(free, heapq.heappop(active)[1])
+            if free:
+                reg = heapq.heappop(free)
+            else:
+                count += 1
+                reg = count
+            if reg > 31:
+                raise ValueError('Out of registers')
+            mapping[idx] = reg
+            heapq.heappush(active, (end, reg))
+
+        rename = lambda reg: Reg(RegType.GENERAL, mapping[reg.idx]) \
+                             if reg is not None and reg.type == RegType.GENERAL else reg
+        for bundle in self.schedule:
+            for inst in bundle.insts:
+                inst.rd, inst.rs1, inst.rs2 = rename(inst.rd), rename(inst.rs1), rename(inst.rs2)
+                if inst.id >= 0:
+                    depTable[inst.id].renamedDest = inst.rd
 
     def _schedule(self):
 
@@ -43,19 +131,27 @@ class SimpleScheduler:
         iCache = self.p.iCache
         finished_cycle = [None] * len(iCache) # record the cycle when each instruction is finished (i.e. visible)
         depTable = self.p.depTable.table
+        depGraph = self.p.depTable
 
         def schedule_single_bb(range: slice, prev_bb_finished_cycle: int):
             ''' schedule a single basic block '''
             curr_bb_finished_cycle = prev_bb_finished_cycle
-            for i, inst in list(enumerate(iCache))[range]:
-                deps = depTable[i].localDeps + depTable[i].interLoopDeps + depTable[i].loopInvariantDeps + depTable[i].postLoopDeps
-                earliest_cycle = max((finished_cycle[dep.producer_id] for dep in deps if dep.producer_id is not None),
+            freeSlots = FreeSlots(self.schedule)
+            order = list(enumerate(iCache))[range]
+            if self.p.options.priority == 'height':
+                # longest path to the end of the block first; this is still a
+                # topological order since a producer is higher than its consumers
+                heights = depGraph.heights(range)
+                order.sort(key = lambda t: -heights[t[0]])
+            for i, inst in order:
+                # iterations do not overlap, only same-iteration dependencies matter
+                kinds = EDGE_KINDS if self.p.options.memDeps else DEP_KINDS
+                earliest_cycle = max((finished_cycle[edge.producer_id] for edge in depGraph.inEdges(i, kinds, distance = 0)),
                                      default=prev_bb_finished_cycle)
                 if earliest_cycle < prev_bb_finished_cycle:
                     earliest_cycle = prev_bb_finished_cycle
                 _inst = _Instruction.from_instruction(inst,i)
-                while not self.schedule[earliest_cycle].insert(_inst, inst.class_):
-                    earliest_cycle += 1
+                earliest_cycle = freeSlots.insert(_inst, inst.class_, earliest_cycle)
                 inst_finished_cycle = earliest_cycle + 1 if inst.opcode != 'mulu' else earliest_cycle + 3
                 finished_cycle[i] = inst_finished_cycle
                 if (inst_finished_cycle > curr_bb_finished_cycle):
@@ -69,16 +165,17 @@ class SimpleScheduler:
             # schedule bb1 except the last instruction, i.e. the loop instruction, which is to be scheduled using another strategy
 
             self.bb1_finished_cycle = schedule_single_bb(slice(bb1.start, bb1.stop - 1) , self.bb0_finished_cycle)
+            self.schedule.grow(self.bb1_finished_cycle)
             self.bb2_finished_cycle = schedule_single_bb(self.p.depTable.bb2, self.bb1_finished_cycle)
 
             ''' Step 1.2: properly delay the loop instruction, so that equation 2 is satisfied for all bb1 insts'''
             ii = self.bb1_finished_cycle - self.bb0_finished_cycle
             max_diff = 0
 
-            for cycle, bundle in islice(enumerate(self.schedule), self.bb0_finished_cycle, self.bb1_finished_cycle):
+            for cycle, bundle in enumerate(self.schedule[self.bb0_finished_cycle:self.bb1_finished_cycle], self.bb0_finished_cycle):
                 for inst in bundle.insts:
-                    for dep in depTable[inst.id].interLoopDeps:
-                        sp_id = dep.producer_id_interloop # a interloop dep is guaranteed to have a produer_id_interloop
+                    for edge in depGraph.inEdges(inst.id, ['interLoopDeps'], distance = 1):
+                        sp_id = edge.producer_id
                         sp_finished_cycle = finished_cycle[sp_id] # equivalent to S(p) + lambda(p)\
                         diff = sp_finished_cycle - (ii + cycle) # equation 2: S(p) + lambda(p) - (ii + S(c)) should <= 0
                         if diff > max_diff:
@@ -91,7 +188,6 @@ class SimpleScheduler:
  
 
         ''' Step 2.1: Rename registers'''
-        self.sort()
         class FreshRegGenerator:
             ''' fresh register generator '''
             cnt: int = 0
@@ -109,38 +205,19 @@ class SimpleScheduler:
         ''' Step 2.2: link the operands to the renamed registers'''
         for bundle in self.schedule:
             for inst in bundle.insts:
-                deps = depTable[inst.id].localDeps         \
-                     + depTable[inst.id].interLoopDeps     \
-                     + depTable[inst.id].loopInvariantDeps \
-                     + depTable[inst.id].postLoopDeps
+                # the producer before the loop if any, else the inter-loop one
                 if inst.rs1 is not None:
-                    prodId = next((dep.producer_id for dep in deps if dep.consumer_reg == inst.rs1), None)
-                    if prodId is None:
-                        # check if it has a interloop dependency
-                        prodId = next((dep.producer_id_interloop for dep in depTable[inst.id].interLoopDeps if dep.consumer_reg == inst.rs1), None)
-                        if prodId is None:
-                            inst.rs1 = nullReg
-                        else:
-                            inst.rs1 = depTable[prodId].renamedDest
-                    else:
-                        inst.rs1 = depTable[prodId].renamedDest
+                    prodId = depGraph.producerOf(inst.id, inst.rs1)
+                    inst.rs1 = nullReg if prodId is None else depTable[prodId].renamedDest
                 if inst.rs2 is not None:
-                    prodId = next((dep.producer_id for dep in deps if dep.consumer_reg == inst.rs2), None)
-                    if prodId is None:
-                        # check if it has a interloop dependency
-                        prodId = next((dep.producer_id_interloop for dep in depTable[inst.id].interLoopDeps if dep.consumer_reg == inst.rs2), None)
-                        if prodId is None:
-                            inst.rs2 = nullReg
-                        else:
-                            inst.rs2 = depTable[prodId].renamedDest
-                    else:
-                        inst.rs2 = depTable[prodId].renamedDest
+                    prodId = depGraph.producerOf(inst.id, inst.rs2)
+                    inst.rs2 = nullReg if prodId is None else depTable[prodId].renamedDest
 
         ''' Step 2.3: fix the interloop dependencies '''
         if (bb1.stop != bb1.start):
             interLoopDeps = [entry.interLoopDeps for entry in depTable[bb1]]
             interLoopDeps = [item for sublist in interLoopDeps for item in sublist] # flatten the list
-            interLoopDeps = set(interLoopDeps) # remove duplicates
+            interLoopDeps = dict.fromkeys(interLoopDeps) # remove duplicates, in program order
             movFinishedCycle = self.bb1_finished_cycle
             oldBb1FinishedCycle = self.bb1_finished_cycle # this is the starting point of all added mov instruction
             for dep in interLoopDeps:
@@ -160,6 +237,7 @@ class SimpleScheduler:
                         self.bb2_finished_cycle += 1
                 #print(self.schedule[currCycle])
                 self.schedule[currCycle].insert(moveInst, InstClass.ALU)
+                self.movCount += 1
             # only now do we schedule the loop instruction
             loop_inst = _Instruction.from_instruction(self.p.iCache[bb1.stop - 1], bb1.stop - 1)
             loop_inst.imm = self.bb0_finished_cycle
@@ -173,6 +251,10 @@ class SimpleScheduler:
                     inst.rs1 = freshReg()
                 if inst.rs2 == nullReg:
                     inst.rs2 = freshReg()
+
+        ''' Step 3: reuse the registers of dead values '''
+        if self.p.options.reuseRegs:
+            self.allocateRegisters()
          
 
                         
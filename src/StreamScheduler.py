@@ -0,0 +1,226 @@
+from collections import deque
+from typing      import Iterable, Iterator, TextIO
+import json
+
+from type import RegType, Reg, InstClass, _Instruction, Bundle
+from VLIW470 import VLIW470
+
+
+def readInstructions(f: TextIO, chunkSize: int = 1 << 16) -> Iterator[str]:
+    ''' yield the instructions of a JSON array, or of one JSON string per line
+    (NDJSON), reading `f` a chunk at a time '''
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    while True:
+        # `[`, `,` and whitespace only separate the strings
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,[':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            inst, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                if pos == len(buffer):
+                    return
+                raise
+            chunk = f.read(chunkSize)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield inst
+
+
+class StreamScheduler:
+    ''' loop schedule of a program streamed one instruction at a time
+
+    Produces the schedule of `SimpleScheduler` up to the names of the
+    registers, writing each bundle to `out` as soon as it is final, so memory
+    stays bounded by `window` and `lookahead` rather than the program size:
+
+    * BB0 and BB2 are scheduled ASAP in a sliding window of the last `window`
+      cycles. Older bundles are renamed and written; an instruction whose
+      ASAP cycle has been written already goes to the oldest cycle of the
+      window instead (counted in `clamped`).
+    * The last `lookahead` instructions are held back until it is known
+      whether they belong to the loop body, i.e. until `loop` is read. BB1
+      is then scheduled as a whole as in `SimpleScheduler`.
+
+    Producers are linked by the last instruction writing each register, so
+    the instructions of the window, the lookahead and the last writer of
+    every register are all that is kept.
+    '''
+
+    def __init__(self, out: TextIO, window: int = 256, lookahead: int = 4096) -> None:
+        self.decoder = VLIW470([]) # only used to decode
+        self.out = out
+        self.windowSize = window
+        self.lookaheadSize = lookahead
+        self.window: deque[Bundle] = deque()
+        self.base = 0 # cycle of `self.window[0]`
+        self.blockStart = 0
+        self.blockFinished = 0
+        self.lastWriter: dict[Reg, _Instruction] = {}
+        self.freshCount = 0
+        self.written = 0 # number of bundles written
+        self.clamped = 0
+
+    def fresh(self) -> Reg:
+        self.freshCount += 1
+        return Reg(RegType.GENERAL, self.freshCount)
+
+    def write(self, bundle: Bundle) -> None:
+        ''' write a bundle, formatted like `json.dump(..., indent=4)` '''
+        text = json.dumps(bundle.to_list(), indent=4).replace('\n', '\n    ')
+        self.out.write((',\n    ' if self.written else '[\n    ') + text)
+        self.written += 1
+
+    def renameOperands(self, inst: _Instruction) -> None:
+        ''' link the operands to the renamed producers, fresh registers if none '''
+        rs1Producer, rs2Producer = inst.producers
+        if inst.rs1 is not None:
+            inst.rs1 = rs1Producer.rd if rs1Producer is not None else self.fresh()
+        if inst.rs2 is not None:
+            inst.rs2 = rs2Producer.rd if rs2Producer is not None else self.fresh()
+        inst.producers = None # not needed anymore
+
+    def flush(self) -> None:
+        ''' rename and write the oldest bundle of the window '''
+        bundle = self.window.popleft() if self.window else Bundle()
+        for inst in bundle.insts:
+            if inst.rd is not None and inst.rd.type == RegType.GENERAL:
+                inst.rd = self.fresh()
+        for inst in bundle.insts:
+            self.renameOperands(inst)
+        self.write(bundle)
+        self.base += 1
+
+    def bundle(self, cycle: int) -> Bundle:
+        while cycle - self.base >= len(self.window):
+            self.window.append(Bundle())
+        return self.window[cycle - self.base]
+
+    def place(self, inst: _Instruction, class_: InstClass) -> None:
+        ''' schedule an instruction of BB0 or BB2 ASAP within the window '''
+        inst.producers = tuple(self.lastWriter.get(rs) for rs in (inst.rs1, inst.rs2))
+        if inst.rd is not None:
+            self.lastWriter[inst.rd] = inst
+
+        # producers in previous basic blocks have finished by `blockStart`
+        cycle = max([p.finished for p in inst.producers if p is not None] + [self.blockStart])
+        if cycle < self.base:
+            self.clamped += 1
+            cycle = self.base
+        while not self.bundle(cycle).insert(inst, class_):
+            cycle += 1
+        inst.finished = cycle + 3 if inst.opcode == 'mulu' else cycle + 1
+        self.blockFinished = max(self.blockFinished, inst.finished)
+        while len(self.window) > self.windowSize:
+            self.flush()
+
+    def scheduleLoop(self, body: list[tuple[_Instruction, InstClass]], loopInst: _Instruction) -> None:
+        ''' schedule, rename and write BB1 as `SimpleScheduler` does '''
+        # BB0 is final
+        bb0FinishedCycle = self.blockFinished
+        while self.base < bb0FinishedCycle or self.window:
+            self.flush()
+
+        # dependencies within BB1; BB0 producers are the last writers so far
+        lastInBody: dict[Reg, _Instruction] = {inst.rd: inst for inst, _ in body if inst.rd is not None}
+        local: dict[Reg, _Instruction] = {}
+        interLoopDeps: list[tuple] = [] # (consumer, BB0 producer, BB1 producer)
+        for inst, _ in body:
+            producers, inst.localProducers = [], []
+            for rs in (inst.rs1, inst.rs2):
+                if rs in local:
+                    producers.append(local[rs])
+                    inst.localProducers.append(local[rs])
+                elif rs in lastInBody:
+                    # inter-loop dependency: the BB0 producer if any, else the previous iteration
+                    producers.append(self.lastWriter.get(rs) or lastInBody[rs])
+                    interLoopDeps.append((inst, self.lastWriter.get(rs), lastInBody[rs]))
+                else:
+                    producers.append(self.lastWriter.get(rs) if rs is not None else None)
+            inst.producers = tuple(producers)
+            if inst.rd is not None:
+                local[inst.rd] = inst
+        # BB2 depends on the last writers in BB1, else BB0
+        self.lastWriter.update(local)
+
+        # Step 1.1: ASAP; producers in BB0 have finished by `bb0FinishedCycle`
+        schedule: list[Bundle] = []
+        def at(cycle: int) -> Bundle:
+            while cycle - bb0FinishedCycle >= len(schedule):
+                schedule.append(Bundle())
+            return schedule[cycle - bb0FinishedCycle]
+        bb1FinishedCycle = bb0FinishedCycle
+        for inst, class_ in body:
+            cycle = max([p.finished for p in inst.localProducers] + [bb0FinishedCycle])
+            while not at(cycle).insert(inst, class_):
+                cycle += 1
+            inst.cycle = cycle
+            inst.finished = cycle + 3 if inst.opcode == 'mulu' else cycle + 1
+            bb1FinishedCycle = max(bb1FinishedCycle, inst.finished)
+
+        # Step 1.2: delay the loop instruction to satisfy equation 2
+        ii = bb1FinishedCycle - bb0FinishedCycle
+        delay = max([producer.finished - (ii + consumer.cycle) for consumer, _, producer in interLoopDeps] + [0])
+        bb1FinishedCycle += delay
+        at(bb1FinishedCycle - 1)
+
+        # Step 2.1-2.2: rename the destinations, then link the operands
+        for bundle in schedule:
+            for inst in bundle.insts:
+                if inst.rd is not None and inst.rd.type == RegType.GENERAL:
+                    inst.rd = self.fresh()
+        for bundle in schedule:
+            for inst in bundle.insts:
+                self.renameOperands(inst)
+
+        # Step 2.3: fix the inter-loop dependencies, then add the loop instruction
+        oldBb1FinishedCycle = bb1FinishedCycle
+        fixed = set()
+        for _, bb0Producer, bb1Producer in interLoopDeps:
+            if bb0Producer is None or (id(bb0Producer), id(bb1Producer)) in fixed:
+                continue
+            fixed.add((id(bb0Producer), id(bb1Producer)))
+            moveInst = _Instruction(id = -1, opcode = 'mov', rd = bb0Producer.rd, rs1 = bb1Producer.rd)
+            cycle = oldBb1FinishedCycle - 1
+            while cycle < bb1Producer.finished or not at(cycle).canInsert(InstClass.ALU):
+                cycle += 1
+            bb1FinishedCycle = max(bb1FinishedCycle, cycle + 1)
+            at(cycle).insert(moveInst, InstClass.ALU)
+        loopInst.imm = bb0FinishedCycle
+        at(bb1FinishedCycle - 1).insert(loopInst, InstClass.Branch)
+
+        for bundle in schedule:
+            self.write(bundle)
+        self.base = self.blockStart = self.blockFinished = bb1FinishedCycle
+
+    def run(self, insts: Iterable[str]) -> None:
+        ''' schedule and write the whole program '''
+        lookahead: deque[tuple[int, _Instruction, InstClass]] = deque()
+        loopSeen = False
+        for pc, text in enumerate(insts):
+            decoded = self.decoder.decode(text)
+            inst = _Instruction.from_instruction(decoded, pc)
+            if loopSeen:
+                self.place(inst, decoded.class_)
+            elif decoded.opcode == 'loop':
+                # everything before the start of the loop is BB0
+                while lookahead and lookahead[0][0] < decoded.imm:
+                    self.place(*lookahead.popleft()[1:])
+                if decoded.imm >= pc or (lookahead[0][0] if lookahead else pc) != decoded.imm:
+                    raise ValueError(f'Loop body at {decoded.imm} is out of the lookahead of {self.lookaheadSize}')
+                self.scheduleLoop([(i, c) for _, i, c in lookahead], inst)
+                lookahead.clear()
+                loopSeen = True
+            else:
+                lookahead.append((pc, inst, decoded.class_))
+                if len(lookahead) > self.lookaheadSize:
+                    self.place(*lookahead.popleft()[1:])
+        while lookahead:
+            self.place(*lookahead.popleft()[1:])
+        while self.window:
+            self.flush()
+        self.out.write('\n]' if self.written else '[]')
@@ -1,4 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from copy        import deepcopy
+from functools   import cached_property
+from math        import ceil
 
 from type import RegType, Reg, Instruction, InstClass
 from DependencyTable   import DependencyTable
@@ -12,28 +15,111 @@ class VLIW470:
         MUL: int
         MEM: int
         BR: int
+
+    @dataclass
+    class Options:
+        memDeps: bool = False # order `ld`/`st` that may access the same address
+        compactRotRegs: bool = False # size rotating registers by lifetime instead of `numStage + 1`
+        reuseRegs: bool = False # reuse the static registers of dead values in the loop schedule
+        compactPip: bool = False # overlap the loop setup and BB2 with the slack of BB0 in the loop.pip schedule
+        priority: str = 'order' # order of list scheduling in a basic block: 'order' (program order) or 'height'
+        unroll: int = 1 # replicate the loop body, dividing the trip count; implies `memDeps`
+        iiStart: int = 0 # II the loop.pip scheduler starts searching from, if above the resource bound
+        validate: bool = True # statically check the emitted schedules, see `Validator`
+        iiJobs: int = 1 # worker processes trying IIs in parallel once the first II fails
+
+        def __post_init__(self) -> None:
+            # the copies of the body access the same addresses within one iteration
+            if self.unroll != 1:
+                self.memDeps = True
     
     iCache: list[Instruction]
 
     rrb: int # rotating register base
     lc : int # loop   count register
     ec : int # epilog count register
-    depTable: DependencyTable
-    simpleScheduler: SimpleScheduler
-    pipelineScheduler: PipelineScheduler
 
-    def __init__(self, insts: list[str]) -> None:
+    def __init__(self, insts: list[str], options: Options = None) -> None:
+        self.options = options if options is not None else self.Options()
         self.exUnitCount = self.Count(2,1,1,1)
         self.instCount   = self.Count(0,0,0,0)
         
         self.iCache = []
         for inst in insts:
             self.iCache.append(self.decode(inst))
-        self.depTable = DependencyTable(self.iCache)
-        self.simpleScheduler   = SimpleScheduler(self)
-        self.pipelineScheduler = PipelineScheduler(self)
+        if self.options.unroll != 1:
+            self.unroll(self.options.unroll)
+
+    # computed on first use, so that callers only pay for what they need
+    @cached_property
+    def depTable(self) -> DependencyTable:
+        return DependencyTable(self.iCache)
+
+    @cached_property
+    def simpleScheduler(self) -> SimpleScheduler:
+        return SimpleScheduler(self)
+
+    @cached_property
+    def pipelineScheduler(self) -> PipelineScheduler:
+        return PipelineScheduler(self)
 
     
+    def unroll(self, factor: int) -> None:
+        ''' replicate the loop body `factor` times
+
+        The trip count `LC + 1` has to be known, i.e. LC is only set once by a
+        `mov LC, imm` before the loop and never read, and divisible by
+        `factor`.
+        '''
+        loopPc = next((pc for pc, inst in enumerate(self.iCache) if inst.opcode == 'loop'), None)
+        if loopPc is None:
+            raise ValueError('No loop to unroll')
+        start = self.iCache[loopPc].imm
+        lcWrites = [pc for pc, inst in enumerate(self.iCache) if inst.rd is not None and inst.rd.type == RegType.LC]
+        lcReads = [pc for pc, inst in enumerate(self.iCache)
+                      if any(reg is not None and reg.type == RegType.LC for reg in (inst.rs1, inst.rs2))]
+        if len(lcWrites) != 1 or lcWrites[0] >= start or lcReads or self.iCache[lcWrites[0]].imm is None:
+            raise ValueError('Unknown trip count')
+        trips = self.iCache[lcWrites[0]].imm + 1
+        if trips % factor != 0:
+            raise ValueError(f'Trip count {trips} is not a multiple of {factor}')
+
+        self.iCache[lcWrites[0]] = replace(self.iCache[lcWrites[0]], imm = trips // factor - 1)
+        body = self.iCache[start:loopPc]
+        self.iCache = self.iCache[:start] + [deepcopy(inst) for _ in range(factor) for inst in body] \
+                    + self.iCache[loopPc:]
+
+    def resMII(self) -> int:
+        ''' the resource bound of II: the instructions of BB1 per execution unit '''
+        instCount = {clss: 0 for clss in InstClass}
+        exUnitCount = {InstClass.ALU: 2, InstClass.Mulu: 1, InstClass.Mem: 1, InstClass.Branch: 1}
+        for inst in self.iCache[self.depTable.bb1]:
+            instCount[inst.class_] += 1
+        return max(ceil(instCount[clss] / exUnitCount[clss]) for clss in InstClass)
+
+    def loopCount(self) -> int:
+        ''' the value assigned to LC before the loop, 0 if there is none '''
+        bb0 = self.depTable.bb0
+        return next((inst.imm for inst in reversed(self.iCache[bb0])
+                              if inst.opcode == 'mov' and inst.rd.type == RegType.LC and inst.imm is not None), 0)
+
+    def report(self, loopCount: int = None) -> dict:
+        ''' static quality report of both schedules '''
+        if loopCount is None:
+            loopCount = self.loopCount()
+        report = {
+            'loopCount': loopCount,
+            'simple': self.simpleScheduler.report(loopCount),
+            'pip': self.pipelineScheduler.report(loopCount),
+        }
+        report['fastest'] = 'pip' if report['pip']['predictedCycles'] < report['simple']['predictedCycles'] else 'simple'
+        return report
+
+    def fastest(self, loopCount: int = None) -> str:
+        ''' the schedule ('simple' or 'pip') predicted to take fewer cycles,
+        'simple' on a tie '''
+        return self.report(loopCount)['fastest']
+
     def parseReg(self, reg: str) -> Reg:
         ''' parse a register '''
         if reg[0] == 'x':
@@ -0,0 +1,207 @@
+REGISTER_COUNT = 96
+ROTATING_BASE = 32 # x32-x95 and p32-p95 rotate with RRB
+
+# the opcodes each of the 5 slots of a bundle can execute
+SLOT_OPCODES = [{'add', 'addi', 'sub', 'mov'},
+                {'add', 'addi', 'sub', 'mov'},
+                {'mulu'},
+                {'ld', 'st'},
+                {'loop', 'loop.pip'}]
+SLOT_NAMES = ['ALU0', 'ALU1', 'Mult', 'Mem', 'Branch']
+
+
+def isInt(text: str) -> bool:
+    try:
+        int(text, 0)
+        return True
+    except ValueError:
+        return False
+
+
+def regName(reg: tuple) -> str:
+    kind, idx = reg
+    return kind if idx is None else f'{kind}{idx}'
+
+
+def rotate(reg: tuple, offset: int) -> tuple:
+    ''' the name of `reg` after RRB is incremented `offset` times '''
+    kind, idx = reg
+    if kind in ('x', 'p') and idx >= ROTATING_BASE:
+        return kind, ROTATING_BASE + (idx - ROTATING_BASE + offset) % (REGISTER_COUNT - ROTATING_BASE)
+    return reg
+
+
+class Validator:
+    ''' static checks of a schedule, as emitted for the simulator
+
+    Finds, in time linear in the number of bundles:
+
+    * instructions in a slot of the wrong unit, or with malformed operands
+    * registers out of x0-x95 and p0-p95
+    * guards on predicates that are neither rotating nor set by a `mov`
+    * `loop` and `loop.pip` targets that are not an earlier bundle
+    * registers written twice in the same cycle, including by a `mulu`
+      issued two cycles earlier, on any path through the branches and with
+      the rotation of a taken `loop.pip` in between
+
+    Problems are collected in `problems` rather than raised, so that all of
+    them are reported at once.
+    '''
+
+    def __init__(self, schedule: list[list[str]]) -> None:
+        self.schedule = schedule
+        self.problems: list[str] = []
+        self.guards: list[tuple[int, int]] = [] # (pc, predicate)
+        self.movPredicates: set[int] = set()
+        self.hasLoopPip = False
+
+        # per bundle: registers written in its own cycle, the one written by
+        # its `mulu` and the bundles that can run next, with their rotation
+        self.writes: list[list[tuple]] = []
+        self.mulWrites: list[tuple] = []
+        self.successors: list[list[tuple[int, int]]] = []
+        for pc, bundle in enumerate(schedule):
+            self.decodeBundle(pc, bundle)
+        self.checkGuards()
+        self.checkWrites()
+
+    def error(self, pc: int, message: str) -> None:
+        self.problems.append(f'bundle {pc}: {message}')
+
+    def reg(self, pc: int, text: str, kinds: str = 'x') -> tuple:
+        ''' parse a register of one of `kinds`, None if it is not one '''
+        if text[:1] not in kinds or not text[1:].isdigit():
+            self.error(pc, f'expected a register of {", ".join(kinds)}, got "{text}"')
+            return None
+        idx = int(text[1:])
+        if idx >= REGISTER_COUNT:
+            self.error(pc, f'register {text} out of range')
+            return None
+        return text[0], idx
+
+    def decodeBundle(self, pc: int, bundle: list[str]) -> None:
+        writes, mulWrite, successors = [], None, [(pc + 1, 0)]
+        if len(bundle) != len(SLOT_OPCODES):
+            self.error(pc, f'{len(bundle)} slots instead of {len(SLOT_OPCODES)}')
+            bundle = []
+        for slot, text in enumerate(bundle):
+            words = text.split(None, 1)
+            if words and words[0].startswith('('):
+                guard = words[0][1:-1] if words[0].endswith(')') else ''
+                if (reg := self.reg(pc, guard, 'p')) is not None:
+                    self.guards.append((pc, reg[1]))
+                words = words[1].split(None, 1) if len(words) > 1 else []
+            if not words:
+                self.error(pc, f'empty {SLOT_NAMES[slot]} slot')
+                continue
+            opcode, operands = words[0], [op.strip() for op in words[1].split(',')] if len(words) > 1 else []
+            if opcode == 'nop':
+                continue
+            if opcode not in SLOT_OPCODES[slot]:
+                self.error(pc, f'"{text.strip()}" in the {SLOT_NAMES[slot]} slot')
+                continue
+
+            rd = self.decodeOperands(pc, text, opcode, operands)
+            if opcode == 'mulu':
+                mulWrite = rd
+            elif opcode == 'loop':
+                writes.append(('LC', None))
+                if rd is not None:
+                    successors.append((rd, 0))
+            elif opcode == 'loop.pip':
+                self.hasLoopPip = True
+                # p32 is cleared in place when the loop exits, set after rotating otherwise
+                writes += [('LC', None), ('EC', None), ('RBB', None), ('p', ROTATING_BASE), ('p', REGISTER_COUNT - 1)]
+                if rd is not None:
+                    successors.append((rd, 1))
+            elif rd is not None:
+                writes.append(rd)
+
+        self.writes.append(writes)
+        self.mulWrites.append(mulWrite)
+        self.successors.append(successors)
+
+    def decodeOperands(self, pc: int, text: str, opcode: str, operands: list[str]):
+        ''' check the operands; returns the register written, or the target of a branch '''
+        def expect(count: int) -> bool:
+            if len(operands) != count:
+                self.error(pc, f'"{text.strip()}" takes {count} operands')
+                return False
+            return True
+
+        if opcode in ('add', 'sub', 'mulu'):
+            if expect(3):
+                self.reg(pc, operands[1]), self.reg(pc, operands[2])
+                return self.reg(pc, operands[0])
+        elif opcode == 'addi':
+            if expect(3):
+                self.reg(pc, operands[1])
+                if not operands[2].lstrip('-').isdigit(): # the simulator only reads decimal
+                    self.error(pc, f'"{text.strip()}" needs a decimal immediate')
+                return self.reg(pc, operands[0])
+        elif opcode == 'mov':
+            if expect(2):
+                dest, source = operands
+                if dest.upper() in ('LC', 'EC', 'RBB'):
+                    if not isInt(source):
+                        self.error(pc, f'"{text.strip()}" needs an immediate')
+                    return dest.upper(), None
+                if dest.startswith('p'):
+                    if source not in ('true', 'false'):
+                        self.error(pc, f'"{text.strip()}" needs true or false')
+                    if (rd := self.reg(pc, dest, 'p')) is not None:
+                        self.movPredicates.add(rd[1])
+                    return rd
+                if not isInt(source):
+                    self.reg(pc, source)
+                return self.reg(pc, dest)
+        elif opcode in ('ld', 'st'):
+            if expect(2):
+                offset, _, base = operands[1].partition('(')
+                if not base.endswith(')') or (offset and not isInt(offset)):
+                    self.error(pc, f'"{text.strip()}" needs an address imm(xN)')
+                else:
+                    self.reg(pc, base[:-1].strip())
+                rd = self.reg(pc, operands[0])
+                return rd if opcode == 'ld' else None
+        elif opcode in ('loop', 'loop.pip'):
+            if expect(1):
+                if operands[0].isdigit() and int(operands[0]) <= pc:
+                    return int(operands[0])
+                self.error(pc, f'"{text.strip()}" does not branch back to an earlier bundle')
+        return None
+
+    def checkGuards(self) -> None:
+        for pc, idx in self.guards:
+            if not (idx >= ROTATING_BASE and self.hasLoopPip) and idx not in self.movPredicates:
+                self.error(pc, f'predicate p{idx} is never set')
+
+    def checkWrites(self) -> None:
+        for pc, writes in enumerate(self.writes):
+            if len(set(writes)) != len(writes):
+                twice = sorted(set(regName(reg) for reg in writes if writes.count(reg) > 1))
+                self.error(pc, f'{", ".join(twice)} written twice in the same cycle')
+
+        # a `mulu` writes when the bundle 2 cycles later runs, along every path
+        count = len(self.schedule)
+        for pc, mulWrite in enumerate(self.mulWrites):
+            if mulWrite is None:
+                continue
+            for next, rotation in self.successors[pc]:
+                if next >= count:
+                    continue
+                for landing, rotation2 in self.successors[next]:
+                    if landing >= count:
+                        continue
+                    # rotating registers are renamed by the `loop.pip` taken in between
+                    landed = rotate(mulWrite, rotation + rotation2)
+                    if landed in self.writes[landing]:
+                        self.error(landing, f'{regName(landed)} also written by the mulu of bundle {pc}')
+
+
+def validate(schedule: list[list[str]], name: str = 'schedule') -> list[list[str]]:
+    ''' return `schedule` if it passes the static checks, raise ValueError otherwise '''
+    problems = Validator(schedule).problems
+    if problems:
+        raise ValueError(f'Invalid {name}:\n  ' + '\n  '.join(problems))
+    return schedule
@@ -1,35 +1,138 @@
 import argparse
 import json
+from dataclasses import replace
 from VLIW470 import VLIW470
+from Autotuner import Autotuner, SCHEDULES, simulate
+from Server import Server
+from StreamScheduler import StreamScheduler, readInstructions
 import os
+import sys
 
 
-def main(input_path, simple_output_path, pip_output_path):
+def main(input_path, simple_output_path, pip_output_path, report_path=None, loop_count=None,
+         options=None, emit=('simple', 'pip'), best_path=None, memory_path=None):
     with open(input_path, 'r') as f:
         insts = json.load(f)
 
-    compiler = VLIW470(insts)
+    compiler = VLIW470(insts, options)
 
     dep_table_path = os.path.join(os.path.dirname(simple_output_path), "depTable.csv")
     simple_csv_path = os.path.join(os.path.dirname(simple_output_path), "simple.csv")
     pip_csv_path = os.path.join(os.path.dirname(pip_output_path), "pipeline.csv")
-    #compiler.depTable.to_csv(dep_table_path)
-    compiler.simpleScheduler.to_json(simple_output_path)
+    # only the requested outputs are computed
+    if 'deps' in emit:
+        compiler.depTable.to_csv(dep_table_path)
+    if 'simple' in emit:
+        compiler.simpleScheduler.to_json(simple_output_path)
     #compiler.simpleScheduler.to_csv(simple_csv_path)
-    compiler.pipelineScheduler.to_json(pip_output_path)
+    if 'pip' in emit:
+        compiler.pipelineScheduler.to_json(pip_output_path)
+    if best_path is not None:
+        # picked by the cycle model, no simulation needed
+        if compiler.fastest(loop_count) == 'simple':
+            compiler.simpleScheduler.to_json(best_path)
+        else:
+            compiler.pipelineScheduler.to_json(best_path)
+    if report_path is not None:
+        report = compiler.report(loop_count)
+        if memory_path is not None:
+            # check the model: the simulator runs with the LC of the program
+            for name, scheduler in zip(SCHEDULES, (compiler.simpleScheduler, compiler.pipelineScheduler)):
+                report[name]['simulatedCycles'] = simulate(scheduler.to_list(), memory_path)[0]
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
     #compiler.pipelineScheduler.to_csv(pip_csv_path)
     #compiler.depTable.to_csv(dep_table_path)
 
+def autotune(input_path, simple_output_path, pip_output_path, tune_path, options=None,
+             space_path=None, memory_path=None, jobs=None):
+    with open(input_path, 'r') as f:
+        insts = json.load(f)
+    space = None
+    if space_path is not None:
+        with open(space_path, 'r') as f:
+            space = json.load(f)
+
+    tuner = Autotuner(insts, options, space, memory_path, jobs)
+    for name, output_path in (('simple', simple_output_path), ('pip', pip_output_path)):
+        with open(output_path, 'w') as f:
+            json.dump(tuner.best(name)[name]['schedule'], f, indent=4)
+    with open(tune_path, 'w') as f:
+        json.dump(tuner.report(), f, indent=4)
+
+def stream(input_path, simple_output_path, window=256, lookahead=4096):
+    with open(input_path, 'r') as f, open(simple_output_path, 'w') as out:
+        scheduler = StreamScheduler(out, window, lookahead)
+        scheduler.run(readInstructions(f))
+    if scheduler.clamped:
+        print(f'{scheduler.clamped} instructions were scheduled late for lack of window', file=sys.stderr)
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='parse command line arguments')
-    parser.add_argument('input_path', type=str, help='Input file path')
-    parser.add_argument('simple_output_path', type=str, help='Output file path1')
-    parser.add_argument('pip_output_path', type=str, help='Output file path2')
+    parser.add_argument('input_path', type=str, nargs='?', help='Input file path')
+    parser.add_argument('simple_output_path', type=str, nargs='?', help='Output file path1')
+    parser.add_argument('pip_output_path', type=str, nargs='?', help='Output file path2')
+    parser.add_argument('--emit', nargs='+', choices=['simple', 'pip', 'deps'], default=['simple', 'pip'],
+                        help='Outputs to produce; `deps` writes the dependency table to depTable.csv next to the simple output')
+    parser.add_argument('--report', type=str, default=None, help='Output file path of the schedule quality report')
+    parser.add_argument('--best', type=str, default=None, help='Output file path of the schedule the cycle model predicts to be faster')
+    parser.add_argument('--loop-count', type=int, default=None, help='LC used to predict cycles in the report (default: the value moved to LC before the loop)')
+    parser.add_argument('--mem-deps', action='store_true', help='Respect dependencies between ld/st that may access the same address')
+    parser.add_argument('--reuse-regs', action='store_true', help='Reuse the registers of dead values in the loop schedule')
+    parser.add_argument('--compact-rot-regs', action='store_true', help='Allocate rotating registers by the lifetime of each value in the pipelined schedule')
+    parser.add_argument('--priority', choices=['order', 'height'], default='order', help='Order in which instructions of a basic block are scheduled')
+    parser.add_argument('--unroll', type=int, default=1, help='Replicate the loop body, dividing the trip count')
+    parser.add_argument('--ii-start', type=int, default=0, help='II the loop.pip scheduler starts from, if above the resource bound')
+    parser.add_argument('--ii-jobs', type=int, default=1, help='Worker processes trying IIs in parallel once the first II of the loop.pip schedule fails')
+    parser.add_argument('--compact-pip', action='store_true', help='Overlap the loop setup and the code after the loop with the slack before it in the pipelined schedule')
+    parser.add_argument('--no-validate', action='store_true', help='Skip the static checks of the emitted schedules')
+    parser.add_argument('--autotune', type=str, default=None, help='Search the options for the fastest schedules and write the chosen options to this file')
+    parser.add_argument('--space', type=str, default=None, help='JSON file mapping options to the values the autotuner tries')
+    parser.add_argument('--memory', type=str, default=None, help='Memory image to rank autotuning candidates with the simulator instead of the cycle model, or to add simulated cycles to --report')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of worker processes for autotuning or serving (default: number of CPUs)')
+    parser.add_argument('--stream', action='store_true', help='Parse (JSON array or NDJSON) and write the loop schedule incrementally; no loop.pip schedule is produced')
+    parser.add_argument('--window', type=int, default=256, help='Number of cycles kept open for scheduling in --stream mode')
+    parser.add_argument('--lookahead', type=int, default=4096, help='Maximum number of instructions in the loop body in --stream mode')
+    parser.add_argument('--serve', action='store_true', help='Compile JSON-lines requests from stdin (or --socket) until EOF instead of a single input')
+    parser.add_argument('--socket', type=str, default=None, help='Unix socket path to serve requests on')
+    parser.add_argument('--cache-size', type=int, default=256, help='Number of responses the server keeps')
 
     args = parser.parse_args()
+    if args.stream:
+        if args.simple_output_path is None:
+            parser.error('input_path and simple_output_path are required')
+    elif not args.serve and args.pip_output_path is None:
+        parser.error('input_path, simple_output_path and pip_output_path are required')
 
-    main(args.input_path, args.simple_output_path, args.pip_output_path)
+    options = VLIW470.Options(memDeps = args.mem_deps,
+                              compactRotRegs = args.compact_rot_regs,
+                              reuseRegs = args.reuse_regs,
+                              compactPip = args.compact_pip,
+                              priority = args.priority,
+                              unroll = args.unroll,
+                              iiStart = args.ii_start,
+                              iiJobs = args.ii_jobs,
+                              validate = not args.no_validate)
+    if args.stream:
+        if replace(options, validate = True) != VLIW470.Options():
+            parser.error('--stream only supports the default options')
+        stream(args.input_path, args.simple_output_path, args.window, args.lookahead)
+    elif args.serve:
+        server = Server(args.jobs, args.cache_size)
+        try:
+            if args.socket is not None:
+                server.serveSocket(args.socket)
+            else:
+                server.serveStdio()
+        finally:
+            server.close()
+    elif args.autotune is not None:
+        autotune(args.input_path, args.simple_output_path, args.pip_output_path, args.autotune, options,
+                 args.space, args.memory, args.jobs)
+    else:
+        main(args.input_path, args.simple_output_path, args.pip_output_path, args.report, args.loop_count,
+             options, args.emit, args.best, args.memory)
 
 
     
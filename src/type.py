@@ -2,7 +2,6 @@ from collections import namedtuple
 from enum        import Enum
 from dataclasses import dataclass, field
 from typing      import Union
-import sys
 
 
 RegType = Enum('RegType', ['GENERAL', 'PREDICATE', 'LC', 'EC', 'RRB'])
@@ -99,106 +98,166 @@ class _Instruction:
             return f" loop {self.imm}"
 
 
+# the execution unit of each slot of a bundle
+SLOTS = [InstClass.ALU, InstClass.ALU, InstClass.Mulu, InstClass.Mem, InstClass.Branch]
+SLOT_INDICES = {clss: [idx for idx, slot in enumerate(SLOTS) if slot == clss] for clss in InstClass}
+
 @dataclass
 class Bundle:
+    ''' one slot per execution unit, so the instructions are always in the
+    order ALU1, ALU2, Mulu, Mem, Branch; `counts` is the number of slots
+    taken per class '''
+
+    slots: list[_Instruction] = field(default_factory=lambda: [None] * len(SLOTS))
+    counts: dict[InstClass, int] = field(default_factory=lambda: dict.fromkeys(InstClass, 0))
 
-    insts: list[_Instruction] = field(default_factory=list)
-    template: list[InstClass] = field(default_factory=list)
+    @property
+    def insts(self) -> list[_Instruction]:
+        return [inst for inst in self.slots if inst is not None]
+
+    @property
+    def template(self) -> list[InstClass]:
+        return [SLOTS[idx] for idx, inst in enumerate(self.slots) if inst is not None]
 
     def insert(self, inst: _Instruction, class_: InstClass):
         ''' try scheduling an instruction '''
-        if class_ == InstClass.ALU:
-            if self.template.count(InstClass.ALU) < 2:
-                self.insts.append(inst)
-                self.template.append(class_)
-                return True
-            else:
-                return False
-        else:
-            if class_ not in self.template:
-                self.insts.append(inst)
-                self.template.append(class_)
-                return True
-            else:
-                return False
+        count = self.counts[class_]
+        if count == len(SLOT_INDICES[class_]):
+            return False
+        self.slots[SLOT_INDICES[class_][count]] = inst
+        self.counts[class_] = count + 1
+        return True
     def canInsert(self, class_: InstClass):
-        if class_ == InstClass.ALU:
-            return self.template.count(InstClass.ALU) < 2
-        else:
-            return class_ not in self.template
-    # make both insts and template appear in the following sequence: ALU1, ALU2, Mulu, Mem, Branch
-    def sort(self):
-        if len(self.insts) <= 1:
-            return        
-        zipped = zip(self.insts, self.template)
-        priority = {InstClass.ALU: 0, InstClass.Mulu: 1, InstClass.Mem: 2, InstClass.Branch: 3}
-        zipped = sorted(zipped, key=lambda x: priority[x[1]])
-        self.insts, self.template = map(list, zip(*zipped))
+        return self.counts[class_] < len(SLOT_INDICES[class_])
+    def pop(self, class_: InstClass) -> _Instruction:
+        ''' undo the last `insert` of `class_` '''
+        self.counts[class_] -= 1
+        idx = SLOT_INDICES[class_][self.counts[class_]]
+        inst, self.slots[idx] = self.slots[idx], None
+        return inst
     # convert the bundle to a list of strings, in the order of the execution unit, with 'nop' added
-    # MUST BE CALLED AFTER sort()!!!
     def to_list(self):
-        lst = []
-        format = [InstClass.ALU, InstClass.ALU, InstClass.Mulu, InstClass.Mem, InstClass.Branch]
-        i = 0
-        for cls in format:
-            if i < len(self.template) and cls == self.template[i]:
-                #lst.append(str(self.insts[i].id) + str(self.insts[i]))
-                try:
-                    #lst.append(str(self.insts[i].id) + str(self.insts[i]))
-                    lst.append(str(self.insts[i]))
-                except Exception as e:
-                    print(f"An error occurred: {e}")
-                    print(self.insts[i].opcode)
-                    sys.exit()
-                i += 1
-            else:
-                lst.append('nop')
-        assert i == len(self.insts)
-        return lst
+        return [str(inst) if inst is not None else 'nop' for inst in self.slots]
 
     def to_list_pip(self, depTable, # `list[DependencyTableEntry]`
                           added: int) -> list:
         lst = []
-        format = [InstClass.ALU, InstClass.ALU, InstClass.Mulu, InstClass.Mem, InstClass.Branch]
-        i = 0
-        for cls in format:
-            if i < len(self.template) and cls == self.template[i]:
-                try:
-                    if self.insts[i].opcode == 'loop':
-                        lst.append(f" loop.pip {self.insts[i].imm + added}")
-                    elif self.insts[i].id < 0:
-                        if self.insts[i].rd.type == RegType.PREDICATE:
-                            lst.append(f" mov {self.insts[i].rd}, true")
-                        else:
-                            lst.append(str(self.insts[i]))
-                    elif (s := depTable[self.insts[i].id].stage) is not None:
-                        lst.append(f" (p{32 + s}) " + str(self.insts[i]))
-                    else:
-                        lst.append(str(self.insts[i]))
-                except Exception as e:
-                    print(f"An error occurred: {e}")
-                    print(self.insts[i])
-                    sys.exit()
-                i += 1
-            else:
+        for inst in self.slots:
+            if inst is None:
                 lst.append('nop')
-        assert i == len(self.insts)
+            elif inst.opcode == 'loop':
+                lst.append(f" loop.pip {inst.imm + added}")
+            elif inst.id < 0:
+                if inst.rd.type == RegType.PREDICATE:
+                    lst.append(f" mov {inst.rd}, true")
+                else:
+                    lst.append(str(inst))
+            elif (s := depTable[inst.id].stage) is not None:
+                lst.append(f" (p{32 + s}) " + str(inst))
+            else:
+                lst.append(str(inst))
         return lst
     
-class AutoExtendList(list):
-    def __getitem__(self, index: Union[int, slice]):    
+class ScheduleView:
+    ''' the bundles of cycles [start, stop) of a schedule, without copying '''
+
+    def __init__(self, bundles: list[Bundle], start: int, stop: int) -> None:
+        self.bundles = bundles
+        self.start = start
+        self.stop = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __iter__(self):
+        return (self.bundles[cycle] for cycle in range(self.start, self.stop))
+
+    def __getitem__(self, index: int) -> Bundle:
+        if not -len(self) <= index < len(self):
+            raise IndexError(f'index {index} out of a view of {len(self)} bundles')
+        return self.bundles[self.start + index % len(self)]
+
+class Schedule:
+    ''' the bundles of a schedule, indexed by cycle
+
+    Reading never grows the schedule, `grow` and `at` do. Slices are
+    `ScheduleView`s over the same bundles. `rollback` drops the bundles
+    appended since a `checkpoint`; the bundles that existed then must not
+    be changed in between.
+    '''
+
+    def __init__(self, bundles: list[Bundle] = None) -> None:
+        self.bundles: list[Bundle] = bundles if bundles is not None else []
+
+    def __len__(self) -> int:
+        return len(self.bundles)
+
+    def __iter__(self):
+        return iter(self.bundles)
+
+    def __getitem__(self, index: Union[int, slice]):
         if isinstance(index, int):
-            if index >= len(self):
-                self.extend(Bundle() for _ in range(index + 1 - len(self)))
-            return super().__getitem__(index)
+            return self.bundles[index]
         elif isinstance(index, slice):
-            if index.stop >= len(self):
-                self.extend(Bundle() for _ in range(index.stop + 1 - len(self)))
-            return AutoExtendList(super().__getitem__(index))
+            start = index.start if index.start is not None else 0
+            stop = index.stop if index.stop is not None else len(self.bundles)
+            if index.step is not None or start < 0 or stop > len(self.bundles):
+                raise IndexError(f'invalid view [{start}:{stop}] of {len(self.bundles)} bundles')
+            return ScheduleView(self.bundles, start, max(start, stop)) # empty if `stop < start`, as for lists
         else:
             raise TypeError(f'invalid index type: {type(index)}')
 
-    def __setitem__(self, index, value):
-        if index >= len(self):
-            self.extend(Bundle() for _ in range(index + 1 - len(self)))
-        super().__setitem__(index, value)
+    def grow(self, length: int) -> None:
+        ''' append empty bundles up to `length` '''
+        self.bundles.extend(Bundle() for _ in range(length - len(self.bundles)))
+
+    def at(self, cycle: int) -> Bundle:
+        ''' the bundle of `cycle`, growing the schedule to it '''
+        self.grow(cycle + 1)
+        return self.bundles[cycle]
+
+    def insert(self, cycle: int, bundle: Bundle) -> None:
+        ''' insert a bundle at `cycle`, delaying the later ones '''
+        self.bundles.insert(cycle, bundle)
+
+    def checkpoint(self) -> int:
+        return len(self.bundles)
+
+    def rollback(self, checkpoint: int) -> None:
+        del self.bundles[checkpoint:]
+
+class FreeSlots:
+    ''' first cycle at or after a given one with a free slot of a class
+
+    A union-find "next free cycle" forest per class over a schedule: a
+    cycle known to be full points further down, and probes compress their
+    path, so runs of full bundles are skipped in near-constant amortized
+    time. Slots are only ever taken, and a root is checked against its
+    bundle before it is returned, so bundles filled behind the back of the
+    index are picked up too. Cycles must not shift while it is in use.
+    '''
+
+    def __init__(self, schedule: Schedule) -> None:
+        self.schedule = schedule
+        self.next: dict[InstClass, dict[int, int]] = {clss: {} for clss in InstClass}
+
+    def find(self, class_: InstClass, cycle: int) -> int:
+        next = self.next[class_]
+        path = []
+        while True:
+            while cycle in next:
+                path.append(cycle)
+                cycle = next[cycle]
+            if cycle >= len(self.schedule) or self.schedule[cycle].canInsert(class_):
+                break
+            path.append(cycle)
+            cycle += 1
+        for visited in path:
+            next[visited] = cycle
+        return cycle
+
+    def insert(self, inst: _Instruction, class_: InstClass, cycle: int) -> int:
+        ''' schedule an instruction at the first free cycle from `cycle` on, and return it '''
+        cycle = self.find(class_, cycle)
+        self.schedule.at(cycle).insert(inst, class_)
+        return cycle
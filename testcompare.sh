@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# compare.py --rename on pairs of schedules whose verdict is known
+status=0
+for tnum in ./compare_tests/*
+do
+    output=$(python compare.py --rename --loop $tnum/result.json --refLoop $tnum/ref.json)
+    if echo "$output" | grep -q PASSED; then verdict=pass; else verdict=fail; fi
+    if [ "$verdict" != "$(cat $tnum/expected.txt)" ]; then
+        echo "$tnum: expected $(cat $tnum/expected.txt), got $verdict"
+        echo "$output"
+        status=1
+    fi
+done
+exit $status